@@ -19,10 +19,11 @@ import os
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Define scripts in order
+# TTMATRIX-HSR.py computes all network-speed scenarios listed in its
+# scenario_speeds_kmh setting (noHSR and HSR by default) from one graph build
 scripts = [
     os.path.join(ROOT_DIR, "GRID-toolkit", "GRID-gen.py"),
     os.path.join(ROOT_DIR, "GRID-toolkit", "GRID-data.py"),
-    os.path.join(ROOT_DIR, "TTMATRIX-toolkit", "TTMATRIX-noHSR.py"),
     os.path.join(ROOT_DIR, "TTMATRIX-toolkit", "TTMATRIX-HSR.py"),
 ]
 
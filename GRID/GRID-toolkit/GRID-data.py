@@ -8,6 +8,7 @@
 #          and creates a bilateral distance matrix for analysis.
 #
 # Dependencies: geopandas, pandas, shapely, scipy, numpy
+#               (grid_tools.py in this folder)
 # ================================================================
 
 
@@ -21,6 +22,13 @@ OUTPUT_FOLDER = "output"
 OUTPUT_GRID_NAME = "grid-data.shp"
 OUTPUT_CENTROID_NAME = "../../TTMATRIX-toolkit/Input/centroids-data.shp"
 TOTAL_WORKERS = 10_000_000  # default total number of workers in the economy
+DISTANCE_MATRIX_FORMATS = ["csv"]  # any of "csv", "npy" (memory-mappable, with _ids.csv sidecar), "mat" (MATLAB), "tiles" (chunked .npy folder)
+DISTANCE_MATRIX_MEMORY_BUDGET_GB = None  # tiled mode: compute and stream the matrix in row blocks within this budget (GB); not with "mat"
+WINDOW = None  # (minx, miny, maxx, maxy) in WINDOW_CRS or a polygon file; None = whole grid. Filters grid, centroids and inputs at read time
+WINDOW_CRS = None  # CRS of a bounding-box window, e.g. "EPSG:4326"; None = CRS of the grid
+WINDOW_BUFFER_M = 0  # grid cells within this distance (meters) beyond the window are processed too
+POINT_INDEXING = False  # point inputs only: read coordinates without geometries and assign cell_id arithmetically from the grid manifest (grid.json) instead of a spatial join; a point on a cell edge counts once (square: cell to its east/south), not in every touching cell
+PYRAMID_FACTORS = None  # as in GRID-gen, e.g. [2, 4, 8]: join once to grid.shp and roll up to grid-x2.shp, ... (outputs grid-data-x2.shp, ...); a WINDOW is widened to whole cells of the coarsest level
 
 # User-defined variable names
 POP_DENSITY_VAR = "pop_sh"
@@ -33,7 +41,7 @@ import subprocess
 import sys
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-for pkg in ["geopandas", "pandas", "shapely"]:
+for pkg in ["geopandas", "pandas", "shapely", "pyogrio"]:
     try:
         __import__(pkg)
     except ImportError:
@@ -44,17 +52,72 @@ import pandas as pd
 import os
 import numpy as np
 from scipy.spatial import distance_matrix
+from pyproj import Transformer
+from shapely import box, union_all
+from grid_tools import (
+    level_path, point_cell_ids, read_grid_manifest, read_point_coordinates, read_vector, roll_up_means
+)
+
+# Matrix output is shared with the TTMATRIX-toolkit (GRID/matrix_io.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matrix_io import block_rows_for_budget, open_matrix_writers, stream_matrix_blocks
+
+# =============================
+# SPATIAL WINDOW
+# =============================
+def window_mask(window, crs, buffer_m=0):
+    """Window polygon as a one-element GeoSeries for read_file(mask=...), buffered by buffer_m meters."""
+    if isinstance(window, str):
+        shapes = gpd.read_file(window)
+        mask = gpd.GeoSeries([union_all(shapes.geometry.values)], crs=shapes.crs)
+    else:
+        mask = gpd.GeoSeries([box(*window)], crs=crs)
+    if buffer_m:
+        metric_crs = mask.crs if mask.crs.is_projected else mask.estimate_utm_crs()
+        mask = mask.to_crs(metric_crs).buffer(buffer_m).to_crs(mask.crs)
+    return mask
 
 # =============================
 # MAIN SCRIPT
 # =============================
 
+# Pyramid levels need the parent_<f> columns written by GRID-gen.py
+pyramid_factors = sorted(set(PYRAMID_FACTORS or []) - {1})
+grid_columns = gpd.read_file(GRID_SHAPE_PATH, rows=0).columns
+for factor in pyramid_factors:
+    if f"parent_{factor}" not in grid_columns:
+        raise ValueError(f"'parent_{factor}' not found in {GRID_SHAPE_PATH}. Run GRID-gen.py with PYRAMID_FACTORS = {PYRAMID_FACTORS}.")
+
+# Step 0: Grid cells within the window (optional); inputs are then only read around these cells
+grid_window = inputs_window = None
+if WINDOW is not None:
+    grid_window = window_mask(WINDOW, WINDOW_CRS or gpd.read_file(GRID_SHAPE_PATH, rows=0).crs, WINDOW_BUFFER_M)
+    if pyramid_factors:
+        # Whole cells of the coarsest level, so that every coarse cell has all of its fine cells
+        top = pyramid_factors[-1]
+        top_gdf = gpd.read_file(level_path(GRID_SHAPE_PATH, top), mask=grid_window)
+        grid_gdf = gpd.read_file(GRID_SHAPE_PATH, mask=gpd.GeoSeries([box(*top_gdf.total_bounds)], crs=top_gdf.crs))
+        grid_gdf = grid_gdf[grid_gdf[f"parent_{top}"].isin(top_gdf["cell_id"])].copy()
+    else:
+        grid_gdf = gpd.read_file(GRID_SHAPE_PATH, mask=grid_window)
+    inputs_window = gpd.GeoSeries([box(*grid_gdf.total_bounds)], crs=grid_gdf.crs)
+    print(f"Window: {len(grid_gdf)} grid cells")
+
 # Step 1: Load all shapefiles in the input folder
+manifest = read_grid_manifest(GRID_SHAPE_PATH) if POINT_INDEXING else None
 input_shapes = []
 for filename in os.listdir(INPUT_FOLDER):
     if filename.lower().endswith(".shp"):
         path = os.path.join(INPUT_FOLDER, filename)
-        gdf = gpd.read_file(path)
+        # Only the variables used below are read (Arrow reader if pyarrow is installed)
+        columns = [POP_DENSITY_VAR, EMPLOYMENT_VAR, "devle"]
+        if POINT_INDEXING:
+            # Coordinates only, no geometries: cell IDs come from the lattice in grid.json
+            gdf, x, y, crs = read_point_coordinates(path, columns=columns, mask=inputs_window)
+            x, y = Transformer.from_crs(crs, manifest["crs"], always_xy=True).transform(x, y)
+            gdf["cell_id"] = point_cell_ids(manifest, x, y)
+        else:
+            gdf = read_vector(path, columns=columns, mask=inputs_window)
         input_shapes.append(gdf)
 
 # Step 2: Merge all input shapefiles
@@ -63,20 +126,29 @@ if not input_shapes:
 merged_gdf = pd.concat(input_shapes, ignore_index=True)
 
 # Step 3: Load the grid and centroids
-grid_gdf = gpd.read_file(GRID_SHAPE_PATH)
-centroid_gdf = gpd.read_file(CENTROID_PATH)
-
-# Step 4: Ensure both layers use same CRS
-if merged_gdf.crs != grid_gdf.crs:
-    merged_gdf = merged_gdf.to_crs(grid_gdf.crs)
-
-# Step 5: Spatial join (attach grid cell IDs to input features)
-intersection = gpd.sjoin(
-    merged_gdf,
-    grid_gdf[["cell_id", "geometry"]],
-    how="inner",
-    predicate="intersects"
-)
+if grid_window is None:
+    grid_gdf = gpd.read_file(GRID_SHAPE_PATH)
+    centroid_gdf = gpd.read_file(CENTROID_PATH)
+else:
+    centroid_gdf = gpd.read_file(CENTROID_PATH, mask=inputs_window)
+    centroid_gdf = centroid_gdf[centroid_gdf["cell_id"].isin(grid_gdf["cell_id"])].copy()
+
+if POINT_INDEXING:
+    # Step 4-5: Cell IDs were assigned in Step 1. Drop points outside the grid,
+    # and in cells that were clipped or lie outside the window
+    intersection = merged_gdf[merged_gdf["cell_id"].isin(grid_gdf["cell_id"])]
+else:
+    # Step 4: Ensure both layers use same CRS
+    if merged_gdf.crs != grid_gdf.crs:
+        merged_gdf = merged_gdf.to_crs(grid_gdf.crs)
+
+    # Step 5: Spatial join (attach grid cell IDs to input features)
+    intersection = gpd.sjoin(
+        merged_gdf,
+        grid_gdf[["cell_id", "geometry"]],
+        how="inner",
+        predicate="intersects"
+    )
 
 print("Columns after spatial join:", intersection.columns)
 
@@ -93,126 +165,157 @@ if "cell_id" not in intersection.columns:
 numeric_cols = intersection.select_dtypes(include="number").columns.difference(["cell_id"])
 agg_df = intersection.groupby("cell_id")[numeric_cols].mean().reset_index()
 
-# Step 7: Merge aggregated data back to grid and centroids
-grid_out = grid_gdf.merge(agg_df, on="cell_id", how="left")
-centroid_out = centroid_gdf.merge(agg_df, on="cell_id", how="left")
-
-# Step 8: Clean and filter final dataset
-numeric_cols = grid_out.select_dtypes(include="number").columns
-grid_out[numeric_cols] = grid_out[numeric_cols].fillna(0)
-centroid_out[numeric_cols] = centroid_out[numeric_cols].fillna(0)
-
-print("Available columns in grid_out:", list(grid_out.columns))
-
-# Keep only relevant grid cells
-keep_condition = (
-    (grid_out[EMPLOYMENT_VAR] > 0)
-    | (grid_out[POP_DENSITY_VAR] > 0)
-    | (grid_out["devle"] > 0)
-)
-grid_out = grid_out[keep_condition].copy()
-centroid_out = centroid_out[centroid_out["cell_id"].isin(grid_out["cell_id"])].copy()
-
-# Step 9: Replace 0s in employment and population density
-for col in [EMPLOYMENT_VAR, POP_DENSITY_VAR]:
-    min_val = grid_out.loc[grid_out[col] > 0, col].min()
-    if pd.notna(min_val):
-        grid_out[col] = grid_out[col].replace(0, min_val)
-        centroid_out[col] = centroid_out[col].replace(0, min_val)
+# Step 6b: Pyramid levels reuse the join above: the (feature, cell) pairs are
+# mapped to the parent_<f> cells, so each level equals a join on its own grid
+levels = [(1, grid_gdf, centroid_gdf, agg_df)]
+for factor in pyramid_factors:
+    level_agg = roll_up_means(intersection, numeric_cols, grid_gdf.set_index("cell_id")[f"parent_{factor}"])
+    # Only the parents of the fine cells read above (all of them without a window)
+    level_ids = grid_gdf[f"parent_{factor}"]
+    level_grid = gpd.read_file(level_path(GRID_SHAPE_PATH, factor), mask=inputs_window)
+    level_grid = level_grid[level_grid["cell_id"].isin(level_ids)].copy()
+    level_centroids = gpd.read_file(level_path(CENTROID_PATH, factor), mask=inputs_window)
+    level_centroids = level_centroids[level_centroids["cell_id"].isin(level_ids)].copy()
+    levels.append((factor, level_grid, level_centroids, level_agg))
+
+for level, grid_gdf, centroid_gdf, agg_df in levels:
+    grid_name = level_path(OUTPUT_GRID_NAME, level)
+    centroid_name = level_path(OUTPUT_CENTROID_NAME, level)
+    if pyramid_factors:
+        print(f"Level x{level}: {len(grid_gdf)} grid cells")
+
+    # Step 7: Merge aggregated data back to grid and centroids
+    grid_out = grid_gdf.merge(agg_df, on="cell_id", how="left")
+    centroid_out = centroid_gdf.merge(agg_df, on="cell_id", how="left")
+
+    # Step 8: Clean and filter final dataset
+    numeric_cols = grid_out.select_dtypes(include="number").columns
+    grid_out[numeric_cols] = grid_out[numeric_cols].fillna(0)
+    centroid_out[numeric_cols] = centroid_out[numeric_cols].fillna(0)
+
+    print("Available columns in grid_out:", list(grid_out.columns))
+
+    # Keep only relevant grid cells
+    keep_condition = (
+        (grid_out[EMPLOYMENT_VAR] > 0)
+        | (grid_out[POP_DENSITY_VAR] > 0)
+        | (grid_out["devle"] > 0)
+    )
+    grid_out = grid_out[keep_condition].copy()
+    centroid_out = centroid_out[centroid_out["cell_id"].isin(grid_out["cell_id"])].copy()
+
+    # Step 9: Replace 0s in employment and population density
+    for col in [EMPLOYMENT_VAR, POP_DENSITY_VAR]:
+        min_val = grid_out.loc[grid_out[col] > 0, col].min()
+        if pd.notna(min_val):
+            grid_out[col] = grid_out[col].replace(0, min_val)
+            centroid_out[col] = centroid_out[col].replace(0, min_val)
+        else:
+            print(f"Warning: No positive values found in column '{col}'. Skipping replacement.")
+
+    # Step 10: Compute population and employment shares
+    total_pop = grid_out[POP_DENSITY_VAR].sum()
+    total_emp = grid_out[EMPLOYMENT_VAR].sum()
+
+    if total_pop > 0:
+        grid_out["pop"] = (grid_out[POP_DENSITY_VAR] / total_pop) * TOTAL_WORKERS
+        centroid_out["pop"] = grid_out["pop"]
     else:
-        print(f"Warning: No positive values found in column '{col}'. Skipping replacement.")
-
-# Step 10: Compute population and employment shares
-total_pop = grid_out[POP_DENSITY_VAR].sum()
-total_emp = grid_out[EMPLOYMENT_VAR].sum()
-
-if total_pop > 0:
-    grid_out["pop"] = (grid_out[POP_DENSITY_VAR] / total_pop) * TOTAL_WORKERS
-    centroid_out["pop"] = grid_out["pop"]
-else:
-    grid_out["pop"] = 0
-    centroid_out["pop"] = 0
+        grid_out["pop"] = 0
+        centroid_out["pop"] = 0
 
-if total_emp > 0:
-    grid_out["emp"] = (grid_out[EMPLOYMENT_VAR] / total_emp) * TOTAL_WORKERS
-    centroid_out["emp"] = grid_out["emp"]
-else:
-    grid_out["emp"] = 0
-    centroid_out["emp"] = 0
-
-# Step 11: Generate synthetic wage variable
-random_R = np.random.uniform(0.9, 1.1, size=len(grid_out))
-unnormalized_wage = (grid_out["emp"] ** 0.05) * random_R
-wage = unnormalized_wage / unnormalized_wage.mean()
-grid_out["wage"] = wage
-centroid_out["wage"] = wage
-
-# Step 12: Generate synthetic rent variable
-random_S = np.random.uniform(0.9, 1.1, size=len(grid_out))
-unnormalized_rent = (grid_out["pop"] ** 0.25) * random_S
-rent = unnormalized_rent / unnormalized_rent.mean()
-grid_out["rent"] = rent
-centroid_out["rent"] = rent
-
-# Step 13: Finalize outputs
-final_cols = ["cell_id", "lat", "lon", "pop", "emp", "wage", "rent"]
-grid_out = grid_out[final_cols + ["geometry"]]
-centroid_out = centroid_out[final_cols + ["geometry"]]
-
-# Save shapefiles
-grid_out.to_file(os.path.join(OUTPUT_FOLDER, OUTPUT_GRID_NAME))
-centroid_out.to_file(os.path.join(OUTPUT_FOLDER, OUTPUT_CENTROID_NAME))
-
-# Save CSVs (no geometry)
-grid_out.drop(columns="geometry").to_csv(
-    os.path.join(OUTPUT_FOLDER, OUTPUT_GRID_NAME.replace(".shp", ".csv")),
-    index=False
-)
-centroid_out.drop(columns="geometry").to_csv(
-    os.path.join(OUTPUT_FOLDER, OUTPUT_CENTROID_NAME.replace(".shp", ".csv")),
-    index=False
-)
-
-print(f"Shapefiles and CSVs saved to: {OUTPUT_FOLDER}")
-print(f"Processed data saved to '{OUTPUT_FOLDER}' as '{OUTPUT_GRID_NAME}' and '{OUTPUT_CENTROID_NAME}'")
-
-# =============================
-# Step 14: Create bilateral distance matrix (wide format, meters)
-# =============================
-
-print("Computing bilateral distance matrix...")
-
-# Ensure CRS uses meters
-if centroid_out.crs.is_geographic:
-    centroid_out = centroid_out.to_crs(epsg=3857)
-if grid_out.crs.is_geographic:
-    grid_out = grid_out.to_crs(epsg=3857)
-
-# Coordinates and IDs
-coords = np.array([(geom.x, geom.y) for geom in centroid_out.geometry])
-cell_ids = centroid_out["cell_id"].values
-
-# Pairwise distances
-dist_matrix = distance_matrix(coords, coords)
-
-# Internal distances (1/3 of circle radius)
-grid_out["area_m2"] = grid_out.geometry.area
-grid_out["internal_dist"] = (1 / 3) * np.sqrt(grid_out["area_m2"] / np.pi)
-internal_dist_map = dict(zip(grid_out["cell_id"], grid_out["internal_dist"]))
-
-# Replace diagonal with internal distances
-for i, cid in enumerate(cell_ids):
-    dist_matrix[i, i] = internal_dist_map.get(cid, 0)
-
-# Save distance matrix
-dist_df = pd.DataFrame(
-    dist_matrix,
-    index=cell_ids,
-    columns=[f"cell_id_{cid}" for cid in cell_ids]
-)
-dist_df.insert(0, "cell_id", cell_ids)
-
-dist_path = os.path.join(OUTPUT_FOLDER, "distance_matrix.csv")
-dist_df.to_csv(dist_path, index=False)
-
-print(f"Bilateral distance matrix saved to: {dist_path}")
+    if total_emp > 0:
+        grid_out["emp"] = (grid_out[EMPLOYMENT_VAR] / total_emp) * TOTAL_WORKERS
+        centroid_out["emp"] = grid_out["emp"]
+    else:
+        grid_out["emp"] = 0
+        centroid_out["emp"] = 0
+
+    # Step 11: Generate synthetic wage variable
+    random_R = np.random.uniform(0.9, 1.1, size=len(grid_out))
+    unnormalized_wage = (grid_out["emp"] ** 0.05) * random_R
+    wage = unnormalized_wage / unnormalized_wage.mean()
+    grid_out["wage"] = wage
+    centroid_out["wage"] = wage
+
+    # Step 12: Generate synthetic rent variable
+    random_S = np.random.uniform(0.9, 1.1, size=len(grid_out))
+    unnormalized_rent = (grid_out["pop"] ** 0.25) * random_S
+    rent = unnormalized_rent / unnormalized_rent.mean()
+    grid_out["rent"] = rent
+    centroid_out["rent"] = rent
+
+    # Step 13: Finalize outputs
+    final_cols = ["cell_id", "lat", "lon", "pop", "emp", "wage", "rent"]
+    final_cols += [col for col in grid_out.columns if col.startswith("parent_")]
+    grid_out = grid_out[final_cols + ["geometry"]]
+    centroid_out = centroid_out[final_cols + ["geometry"]]
+
+    # Save shapefiles
+    grid_out.to_file(os.path.join(OUTPUT_FOLDER, grid_name))
+    centroid_out.to_file(os.path.join(OUTPUT_FOLDER, centroid_name))
+
+    # Save CSVs (no geometry)
+    grid_out.drop(columns="geometry").to_csv(
+        os.path.join(OUTPUT_FOLDER, grid_name.replace(".shp", ".csv")),
+        index=False
+    )
+    centroid_out.drop(columns="geometry").to_csv(
+        os.path.join(OUTPUT_FOLDER, centroid_name.replace(".shp", ".csv")),
+        index=False
+    )
+
+    print(f"Shapefiles and CSVs saved to: {OUTPUT_FOLDER}")
+    print(f"Processed data saved to '{OUTPUT_FOLDER}' as '{grid_name}' and '{centroid_name}'")
+
+    # =============================
+    # Step 14: Create bilateral distance matrix (wide format, meters)
+    # =============================
+
+    print("Computing bilateral distance matrix...")
+
+    # Ensure CRS uses meters
+    if centroid_out.crs.is_geographic:
+        centroid_out = centroid_out.to_crs(epsg=3857)
+    if grid_out.crs.is_geographic:
+        grid_out = grid_out.to_crs(epsg=3857)
+
+    # Coordinates and IDs
+    coords = np.array([(geom.x, geom.y) for geom in centroid_out.geometry])
+    cell_ids = centroid_out["cell_id"].values
+
+    # Internal distances (1/3 of circle radius)
+    grid_out["area_m2"] = grid_out.geometry.area
+    grid_out["internal_dist"] = (1 / 3) * np.sqrt(grid_out["area_m2"] / np.pi)
+    internal_dist_map = dict(zip(grid_out["cell_id"], grid_out["internal_dist"]))
+    internal_dist = pd.Series(cell_ids).map(internal_dist_map).fillna(0).to_numpy()
+
+    # Row blocks of pairwise distances with internal distances on the diagonal
+    n_cells = len(coords)
+    if DISTANCE_MATRIX_MEMORY_BUDGET_GB:
+        block_rows = block_rows_for_budget(n_cells, np.float64, DISTANCE_MATRIX_MEMORY_BUDGET_GB * 1e9)
+        print(f"Tiled mode: {block_rows} rows per block")
+    else:
+        block_rows = max(n_cells, 1)
+
+    def distance_blocks():
+        for start in range(0, n_cells, block_rows):
+            block = distance_matrix(coords[start:start + block_rows], coords)
+            rows = np.arange(start, start + len(block))
+            block[rows - start, rows] = internal_dist[rows]
+            yield start, block
+
+    # Save distance matrix (CSV / NPY / MAT / TILES), written block by block
+    writers = open_matrix_writers(
+        os.path.join(OUTPUT_FOLDER, level_path("distance_matrix", level)),
+        DISTANCE_MATRIX_FORMATS,
+        (n_cells, n_cells),
+        np.float64,
+        cell_ids,
+        "cell_id",
+        col_labels=[f"cell_id_{cid}" for cid in cell_ids]
+    )
+    dist_paths = stream_matrix_blocks(distance_blocks(), writers)
+
+    for dist_path in dist_paths:
+        print(f"Bilateral distance matrix saved to: {dist_path}")
@@ -7,7 +7,8 @@
 #          of shapefiles provided in the 'input' folder. The grid
 #          is centered and scaled automatically based on input data.
 #
-# Dependencies: geopandas, shapely, pyproj, pandas, fiona
+# Dependencies: geopandas, shapely, pyproj, pandas, fiona, numpy
+#               (grid_tools.py in this folder)
 # ================================================================
 
 
@@ -23,6 +24,9 @@
 CELL_SIZE_KM = 2
 INPUT_FOLDER = "input"
 OUTPUT_FOLDER = "output"
+CLIP_TO_INPUTS = False  # only emit cells that intersect an input feature (cell_id keeps its full-grid row/col numbering)
+MAX_CELLS_PER_BAND = 1_000_000  # cells are generated, reprojected and written in bands of whole rows of at most this size
+PYRAMID_FACTORS = None  # e.g. [2, 4, 8]: also write nested grids of 2x2, 4x4, 8x8 cells (grid-x2.shp, ...) with parent_<f> id columns
 
 # =============================
 # PACKAGE INSTALLATION
@@ -33,17 +37,21 @@ import sys
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-for pkg in ["geopandas", "shapely", "pyproj", "fiona", "pandas"]:
+for pkg in ["geopandas", "shapely", "pyproj", "fiona", "pandas", "numpy", "pyogrio"]:
     try:
         __import__(pkg)
     except ImportError:
         install(pkg)
 
 import geopandas as gpd
-from shapely.geometry import Polygon, Point
-import pandas as pd
+import numpy as np
 import os
+import shapely
 from pyproj import CRS, Transformer
+from grid_tools import (
+    cell_geometries, cells_touching, level_path, parent_ids, read_vector, row_bands, square_cells, square_manifest,
+    vector_extent, write_grid_manifest
+)
 
 # =============================
 # NEW PRE‑PROCESSING TOOLS
@@ -58,18 +66,8 @@ shapefile_paths = [
 if not shapefile_paths:
     raise RuntimeError(f"No shapefiles found in {INPUT_FOLDER}")
 
-# 2. Load them and merge into a single GeoDataFrame
-gdfs = [gpd.read_file(path) for path in shapefile_paths]
-combined_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
-combined_gdf = combined_gdf.set_geometry("geometry")
-
-# Ensure CRS exists
-if combined_gdf.crs is None:
-    raise RuntimeError("Input shapefiles have no CRS defined.")
-
-# 3. Reproject into WGS84 to get geographic bounds
-combined_gdf = combined_gdf.to_crs("EPSG:4326")
-xmin, ymin, xmax, ymax = combined_gdf.total_bounds
+# 2-3. Geographic bounds of all inputs, from the file metadata (no features are read)
+xmin, ymin, xmax, ymax = vector_extent(shapefile_paths, "EPSG:4326")
 
 # Compute approximate centre in lat/lon
 CENTROID_LON = (xmin + xmax) / 2
@@ -85,9 +83,8 @@ def get_utm_crs(lat, lon):
 
 utm_crs_input = get_utm_crs(CENTROID_LAT, CENTROID_LON)
 
-# 5. Reproject combined shape to UTM to get bounds in meters
-combined_proj = combined_gdf.to_crs(utm_crs_input)
-xmin_m, ymin_m, xmax_m, ymax_m = combined_proj.total_bounds
+# 5. Bounds in meters (only the bounding boxes are reprojected)
+xmin_m, ymin_m, xmax_m, ymax_m = vector_extent(shapefile_paths, utm_crs_input)
 
 # 6. Compute grid dimensions automatically
 cell_size_m = CELL_SIZE_KM * 1000.0
@@ -97,11 +94,22 @@ grid_height_m = ymax_m - ymin_m
 NUM_COLS = int(grid_width_m // cell_size_m) + 1
 NUM_ROWS = int(grid_height_m // cell_size_m) + 1
 
+# Pyramid mode: every level must tile the same extent, so rows and columns
+# are rounded up to a multiple of the coarsest factor
+pyramid_factors = sorted(set(PYRAMID_FACTORS or []) - {1})
+if any(coarse % fine for fine, coarse in zip([1] + pyramid_factors, pyramid_factors)):
+    raise ValueError(f"Each PYRAMID_FACTORS entry must be a multiple of the next smaller one, got {PYRAMID_FACTORS}")
+if pyramid_factors:
+    NUM_COLS = -(-NUM_COLS // pyramid_factors[-1]) * pyramid_factors[-1]
+    NUM_ROWS = -(-NUM_ROWS // pyramid_factors[-1]) * pyramid_factors[-1]
+
 print(f"Auto-computed grid parameters:")
 print(f"  Centre lat/lon = ({CENTROID_LAT:.6f}, {CENTROID_LON:.6f})")
 print(f"  NUM_ROWS = {NUM_ROWS}, NUM_COLS = {NUM_COLS}")
 print(f"  CELL_SIZE_KM = {CELL_SIZE_KM}")
 print(f"  Total coverage: {grid_width_m/1000:.2f} km × {grid_height_m/1000:.2f} km")
+if pyramid_factors:
+    print(f"  Pyramid levels: {', '.join(f'{CELL_SIZE_KM * f:g} km' for f in [1] + pyramid_factors)}")
 
 # =============================
 # MAIN SCRIPT
@@ -132,54 +140,62 @@ grid_height = NUM_ROWS * cell_size_m
 x0 = x_center - (grid_width / 2)
 y0 = y_center + (grid_height / 2)
 
-# Create grid and centroids
-grid_cells = []
-centroids = []
-
-for row in range(NUM_ROWS):
-    for col in range(NUM_COLS):
-        x_left = x0 + col * cell_size_m
-        y_top = y0 - row * cell_size_m
-        x_right = x_left + cell_size_m
-        y_bottom = y_top - cell_size_m
-
-        poly = Polygon([
-            (x_left, y_top),
-            (x_right, y_top),
-            (x_right, y_bottom),
-            (x_left, y_bottom),
-            (x_left, y_top)
-        ])
-        center_x = (x_left + x_right) / 2
-        center_y = (y_top + y_bottom) / 2
-        grid_cells.append(poly)
-        centroids.append(Point(center_x, center_y))
-
-# GeoDataFrames in UTM
-grid_gdf = gpd.GeoDataFrame(geometry=grid_cells, crs=utm_crs)
-centroid_gdf = gpd.GeoDataFrame(geometry=centroids, crs=utm_crs)
-
-# Reproject to WGS84
-grid_gdf = grid_gdf.to_crs("EPSG:4326")
-centroid_gdf = centroid_gdf.to_crs("EPSG:4326")
-
-# Add unique numeric ID (row-wise order)
-centroid_gdf["cell_id"] = range(1, len(centroid_gdf) + 1)
-grid_gdf["cell_id"] = centroid_gdf["cell_id"]  # ensure matching IDs
-
-
-# Add lat/lon to centroids (point geometry)
-centroid_gdf["lon"] = centroid_gdf.geometry.x
-centroid_gdf["lat"] = centroid_gdf.geometry.y
-
-# Add lat/lon to grid centroids (polygon geometry → calculate centroid)
-grid_centroids = grid_gdf.geometry.centroid
-grid_gdf["lon"] = grid_centroids.x
-grid_gdf["lat"] = grid_centroids.y
-
-
-# Save shapefiles
-grid_gdf.to_file(os.path.join(OUTPUT_FOLDER, "grid.shp"))
-centroid_gdf.to_file(os.path.join(OUTPUT_FOLDER, "centroids.shp"))
+# Create grid and centroids band by band (row-wise cell_id order)
+to_wgs84 = Transformer.from_crs(utm_crs, wgs84, always_xy=True)
+footprint = None
+if CLIP_TO_INPUTS:
+    # Geometries only, no attribute columns, reprojected once
+    footprint = shapely.STRtree(np.concatenate([
+        read_vector(path, columns=[]).to_crs(utm_crs).geometry.values for path in shapefile_paths
+    ]))
+
+# Level 1 is the CELL_SIZE_KM grid; each pyramid level merges factor x factor of its cells
+for level in [1] + pyramid_factors:
+    level_cols, level_rows = NUM_COLS // level, NUM_ROWS // level
+    grid_path = level_path(os.path.join(OUTPUT_FOLDER, "grid.shp"), level)
+    centroid_path = level_path(os.path.join(OUTPUT_FOLDER, "centroids.shp"), level)
+    n_written = 0
+
+    for row_start, row_stop in row_bands(level_rows, level_cols, MAX_CELLS_PER_BAND):
+        cell_id, centres, rings = square_cells(x0, y0, cell_size_m * level, level_cols, row_start, row_stop)
+        if footprint is not None:
+            # Drop cells outside the input footprint before anything is reprojected
+            keep = cells_touching(footprint, rings)
+            cell_id, centres, rings = cell_id[keep], centres[keep], rings[keep]
+            if not keep.any():
+                continue
+
+        # Reproject all vertices to WGS84 at once and build the geometries in bulk
+        polygons, points = cell_geometries(centres, rings, to_wgs84)
+        point_xy = shapely.get_coordinates(points)
+        polygon_xy = shapely.get_coordinates(shapely.centroid(polygons))
+
+        # lat/lon: centroid points, and the centroids of the reprojected polygons
+        parents = {
+            f"parent_{factor}": parent_ids(cell_id, level_cols, factor // level)
+            for factor in pyramid_factors if factor > level
+        }
+        centroid_gdf = gpd.GeoDataFrame(
+            {"cell_id": cell_id, "lon": point_xy[:, 0], "lat": point_xy[:, 1], **parents}, geometry=points, crs="EPSG:4326"
+        )
+        grid_gdf = gpd.GeoDataFrame(
+            {"cell_id": cell_id, "lon": polygon_xy[:, 0], "lat": polygon_xy[:, 1], **parents}, geometry=polygons, crs="EPSG:4326"
+        )
+
+        # Save shapefiles (later bands are appended)
+        mode = "w" if n_written == 0 else "a"
+        grid_gdf.to_file(grid_path, mode=mode)
+        centroid_gdf.to_file(centroid_path, mode=mode)
+        n_written += len(cell_id)
+
+    if footprint is not None:
+        print(f"Kept {n_written} of {level_rows * level_cols} cells that intersect the input footprint ({grid_path})")
+        if n_written == 0:
+            # No shapefile was written, so no manifest either
+            raise ValueError(f"No cell of {grid_path} intersects the input features in {INPUT_FOLDER}. "
+                             "Check their geometries, or set CLIP_TO_INPUTS = False.")
+
+    # Lattice parameters next to the shapefile (grid.json), for point indexing in GRID-data
+    write_grid_manifest(grid_path, square_manifest(utm_crs, x0, y0, cell_size_m * level, level_rows, level_cols))
 
 print(f"OK Grid centered on ({CENTROID_LAT}, {CENTROID_LON}) saved in: {OUTPUT_FOLDER}")
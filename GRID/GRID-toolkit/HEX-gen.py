@@ -8,7 +8,8 @@
 #          The grid is centered and scaled to the combined extent
 #          of the input data.
 #
-# Dependencies: geopandas, shapely, pyproj, pandas, math, os
+# Dependencies: geopandas, shapely, pyproj, pandas, numpy, math, os
+#               (grid_tools.py in this folder)
 # ================================================================
 
 # =============================
@@ -22,16 +23,19 @@ import math
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-for pkg in ["geopandas", "shapely", "pyproj", "pandas"]:
+for pkg in ["geopandas", "shapely", "pyproj", "pandas", "numpy", "pyogrio"]:
     try:
         __import__(pkg)
     except ImportError:
         install(pkg)
 
 import geopandas as gpd
-from shapely.geometry import Polygon, Point
-import pandas as pd
+import numpy as np
+import shapely
 from pyproj import CRS, Transformer
+from grid_tools import (
+    cell_geometries, cells_touching, hex_cells, hex_manifest, read_vector, row_bands, vector_extent, write_grid_manifest
+)
 
 # =============================
 # AUTO‑CENTERING BASED ON INPUT SHAPEFILES
@@ -39,6 +43,8 @@ from pyproj import CRS, Transformer
 INPUT_FOLDER = "input"
 OUTPUT_FOLDER = "output"
 HEX_WIDTH_KM = 2  # Width of each hexagon (flat‑topped)
+CLIP_TO_INPUTS = False  # Only emit cells that intersect an input feature (cell_id keeps its full-grid row/col numbering)
+MAX_CELLS_PER_BAND = 1_000_000  # Cells are generated, reprojected and written in bands of whole rows of at most this size
 
 # Read all shapefiles from input folder
 shapefile_paths = [
@@ -50,17 +56,8 @@ shapefile_paths = [
 if not shapefile_paths:
     raise RuntimeError(f"No shapefiles found in {INPUT_FOLDER}")
 
-# Load and merge
-gdfs = [gpd.read_file(path) for path in shapefile_paths]
-combined_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True)).set_geometry("geometry")
-
-# Ensure CRS is defined
-if combined_gdf.crs is None:
-    raise RuntimeError("Input shapefiles have no CRS defined.")
-
-# Reproject to WGS84 for bounds
-combined_gdf = combined_gdf.to_crs("EPSG:4326")
-xmin, ymin, xmax, ymax = combined_gdf.total_bounds
+# Geographic bounds of all inputs, from the file metadata (no features are read)
+xmin, ymin, xmax, ymax = vector_extent(shapefile_paths, "EPSG:4326")
 
 # Calculate centroid
 CENTROID_LON = (xmin + xmax) / 2
@@ -75,8 +72,7 @@ def get_utm_crs(lat, lon):
     )
 
 utm_crs_input = get_utm_crs(CENTROID_LAT, CENTROID_LON)
-combined_proj = combined_gdf.to_crs(utm_crs_input)
-xmin_m, ymin_m, xmax_m, ymax_m = combined_proj.total_bounds
+xmin_m, ymin_m, xmax_m, ymax_m = vector_extent(shapefile_paths, utm_crs_input)
 
 # Compute grid width/height in kilometers
 GRID_WIDTH_KM = (xmax_m - xmin_m) / 1000
@@ -127,52 +123,54 @@ total_grid_h = dy * (NUM_ROWS - 1)
 x0 = x_center - total_grid_w / 2
 y0 = y_center + total_grid_h / 2
 
-# Generate hexagons
-grid_cells = []
-centroids = []
-
-for row in range(NUM_ROWS):
-    for col in range(NUM_COLS):
-        offset_x = col * dx
-        offset_y = row * dy
-        if col % 2 == 1:
-            offset_y += dy / 2
-
-        cx = x0 + offset_x
-        cy = y0 - offset_y
-
-        # Create flat-topped hexagon
-        hex_coords = []
-        for angle in range(0, 360, 60):
-            rad = math.radians(angle)
-            x = cx + s * math.cos(rad)
-            y = cy + s * math.sin(rad)
-            hex_coords.append((x, y))
-        hex_coords.append(hex_coords[0])  # close loop
-
-        poly = Polygon(hex_coords)
-        grid_cells.append(poly)
-        centroids.append(Point(cx, cy))
-
-# Build GeoDataFrames
-grid_gdf = gpd.GeoDataFrame(geometry=grid_cells, crs=utm_crs)
-centroid_gdf = gpd.GeoDataFrame(geometry=centroids, crs=utm_crs)
-
-# Reproject to WGS84
-grid_gdf = grid_gdf.to_crs("EPSG:4326")
-centroid_gdf = centroid_gdf.to_crs("EPSG:4326")
-
-# Add attributes
-centroid_gdf["cell_id"] = range(1, len(centroid_gdf) + 1)
-centroid_gdf["lon"] = centroid_gdf.geometry.x
-centroid_gdf["lat"] = centroid_gdf.geometry.y
-
-grid_gdf["cell_id"] = centroid_gdf["cell_id"]
-grid_gdf["lon"] = grid_gdf.geometry.centroid.x
-grid_gdf["lat"] = grid_gdf.geometry.centroid.y
-
-# Save shapefiles
-grid_gdf.to_file(os.path.join(OUTPUT_FOLDER, "grid.shp"))
-centroid_gdf.to_file(os.path.join(OUTPUT_FOLDER, "centroids.shp"))
+# Generate hexagons band by band (row-wise cell_id order)
+to_wgs84 = Transformer.from_crs(utm_crs, wgs84, always_xy=True)
+grid_path = os.path.join(OUTPUT_FOLDER, "grid.shp")
+centroid_path = os.path.join(OUTPUT_FOLDER, "centroids.shp")
+footprint = None
+if CLIP_TO_INPUTS:
+    # Geometries only, no attribute columns, reprojected once
+    footprint = shapely.STRtree(np.concatenate([
+        read_vector(path, columns=[]).to_crs(utm_crs).geometry.values for path in shapefile_paths
+    ]))
+n_written = 0
+
+for row_start, row_stop in row_bands(NUM_ROWS, NUM_COLS, MAX_CELLS_PER_BAND):
+    cell_id, centres, rings = hex_cells(x0, y0, s, NUM_COLS, row_start, row_stop)
+    if footprint is not None:
+        # Drop cells outside the input footprint before anything is reprojected
+        keep = cells_touching(footprint, rings)
+        cell_id, centres, rings = cell_id[keep], centres[keep], rings[keep]
+        if not keep.any():
+            continue
+
+    # Reproject all vertices to WGS84 at once and build the geometries in bulk
+    polygons, points = cell_geometries(centres, rings, to_wgs84)
+    point_xy = shapely.get_coordinates(points)
+    polygon_xy = shapely.get_coordinates(shapely.centroid(polygons))
+
+    # Add attributes
+    centroid_gdf = gpd.GeoDataFrame(
+        {"cell_id": cell_id, "lon": point_xy[:, 0], "lat": point_xy[:, 1]}, geometry=points, crs="EPSG:4326"
+    )
+    grid_gdf = gpd.GeoDataFrame(
+        {"cell_id": cell_id, "lon": polygon_xy[:, 0], "lat": polygon_xy[:, 1]}, geometry=polygons, crs="EPSG:4326"
+    )
+
+    # Save shapefiles (later bands are appended)
+    mode = "w" if n_written == 0 else "a"
+    grid_gdf.to_file(grid_path, mode=mode)
+    centroid_gdf.to_file(centroid_path, mode=mode)
+    n_written += len(cell_id)
+
+if footprint is not None:
+    print(f"Kept {n_written} of {NUM_ROWS * NUM_COLS} cells that intersect the input footprint")
+    if n_written == 0:
+        # No shapefile was written, so no manifest either
+        raise ValueError(f"No hexagon intersects the input features in {INPUT_FOLDER}. "
+                         "Check their geometries, or set CLIP_TO_INPUTS = False.")
+
+# Lattice parameters next to the shapefile (grid.json), for point indexing in GRID-data
+write_grid_manifest(grid_path, hex_manifest(utm_crs, x0, y0, s, NUM_ROWS, NUM_COLS))
 
 print(f"✅ Hex grid saved with ~{NUM_COLS} cols × ~{NUM_ROWS} rows ({GRID_WIDTH_KM}×{GRID_HEIGHT_KM} km)")
@@ -0,0 +1,297 @@
+# ================================================================
+# MRRH2018 GRID TOOLS
+# Part of the MRRH2018 Toolkit
+#
+# Authors: Gabriel Ahlfeldt & Tobias Seidel
+# Purpose: Shared helpers for the GRID-toolkit scripts. Reads
+#          extents from file metadata and only the needed columns of
+#          input layers, builds square and hexagonal grid cells in
+#          bulk, band by band, indexes nested grid pyramids and maps
+#          points to cells from the grid manifest. Matrix output is in
+#          GRID/matrix_io.py.
+#
+# Dependencies: numpy, pandas, pyogrio, pyproj, shapely (>= 2.0)
+#               (pyarrow optional, for faster reads)
+# ================================================================
+
+import importlib.util
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+
+WKB_POINT = np.dtype([("order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")])  # little-endian 2-D WKB point
+
+# Unit vertex offsets of a flat-topped hexagon, counter-clockwise from the right-hand vertex
+HEX_VERTICES = np.array([(math.cos(math.radians(a)), math.sin(math.radians(a))) for a in range(0, 360, 60)])
+
+
+# =============================
+# INPUT READING
+# =============================
+def vector_extent(paths, crs):
+    """Combined (xmin, ymin, xmax, ymax) of vector files in crs, without reading attributes or geometries.
+
+    Files already in crs use the extent in their metadata. Otherwise the
+    per-feature bounding boxes are read (pyogrio.read_bounds) and only
+    their corners are reprojected, in one call per file. For small
+    features this is as tight as reprojecting the full geometries.
+    """
+    crs = CRS.from_user_input(crs)
+    bounds = []
+    for path in paths:
+        info = pyogrio.read_info(path, force_total_bounds=True)
+        if info["crs"] is None:
+            raise RuntimeError(f"Input file has no CRS defined: {path}")
+        if CRS.from_user_input(info["crs"]) == crs:
+            bounds.append(info["total_bounds"])
+            continue
+        _, (x_min, y_min, x_max, y_max) = pyogrio.read_bounds(path)
+        transformer = Transformer.from_crs(CRS.from_user_input(info["crs"]), crs, always_xy=True)
+        x, y = transformer.transform(np.concatenate([x_min, x_max, x_min, x_max]),
+                                     np.concatenate([y_min, y_min, y_max, y_max]))
+        bounds.append((x.min(), y.min(), x.max(), y.max()))
+    bounds = np.array(bounds)
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+
+def read_vector(path, columns=None, mask=None):
+    """GeoDataFrame with only the listed attribute columns that exist in the file.
+
+    mask is an optional GeoSeries; only features intersecting it are read.
+    Uses the Arrow-backed reader when pyarrow is installed.
+    """
+    columns, mask = _read_filters(path, columns, mask)
+    return pyogrio.read_dataframe(path, columns=columns, mask=mask,
+                                  use_arrow=importlib.util.find_spec("pyarrow") is not None)
+
+
+def read_point_coordinates(path, columns=None, mask=None):
+    """Attribute DataFrame, x and y arrays and CRS of a point layer, without building geometries.
+
+    columns and mask work as in read_vector. Geometries arrive as 2-D WKB;
+    plain little-endian points are decoded with NumPy, anything else goes
+    through shapely. Raises ValueError for missing or non-point geometries.
+    """
+    columns, mask = _read_filters(path, columns, mask)
+    meta, _, wkb, field_data = pyogrio.raw.read(path, columns=columns, mask=mask, force_2d=True)
+    attributes = pd.DataFrame(dict(zip(meta["fields"], field_data)))
+    try:
+        plain = (np.fromiter(map(len, wkb), dtype=np.int64, count=len(wkb)) == WKB_POINT.itemsize).all()
+    except TypeError:  # missing geometries
+        plain = False
+    if plain:
+        records = np.frombuffer(b"".join(wkb), dtype=WKB_POINT)
+        if (records["order"] == 1).all() and (records["type"] == 1).all():
+            return attributes, records["x"].copy(), records["y"].copy(), meta["crs"]
+    geometries = shapely.from_wkb(wkb)
+    if not (shapely.get_type_id(geometries) == shapely.GeometryType.POINT).all():
+        raise ValueError(f"{path} has missing or non-point geometries; point indexing needs points.")
+    return attributes, shapely.get_x(geometries), shapely.get_y(geometries), meta["crs"]
+
+
+def _read_filters(path, columns, mask):
+    """Columns that exist in the file, and mask as one geometry in the file's CRS."""
+    info = pyogrio.read_info(path)
+    if columns is not None:
+        columns = [column for column in columns if column in set(info["fields"])]
+    if mask is not None:
+        if info["crs"] is not None:
+            mask = mask.to_crs(info["crs"])
+        mask = shapely.union_all(mask.values)
+    return columns, mask
+
+
+# =============================
+# GRID GENERATION
+# =============================
+# Cells are laid out row by row from the upper-left origin (x0, y0) and
+# numbered cell_id = row * n_cols + col + 1. Generators work on a band of
+# whole rows at a time, with all vertices held in NumPy arrays.
+def row_bands(n_rows, n_cols, max_cells=1_000_000):
+    """Yield (row_start, row_stop) bands of whole rows with at most max_cells cells each."""
+    rows_per_band = max(1, max_cells // max(n_cols, 1))
+    for start in range(0, n_rows, rows_per_band):
+        yield start, min(start + rows_per_band, n_rows)
+
+
+def square_cells(x0, y0, cell_size, n_cols, row_start, row_stop):
+    """cell_id, centres (n, 2) and closed vertex rings (n, 5, 2) of the square cells in rows row_start:row_stop."""
+    row, col = np.divmod(np.arange(row_start * n_cols, row_stop * n_cols), n_cols)
+    x_left = x0 + col * cell_size
+    y_top = y0 - row * cell_size
+    x_right = x_left + cell_size
+    y_bottom = y_top - cell_size
+    rings = np.stack([
+        np.column_stack([x_left, y_top]),
+        np.column_stack([x_right, y_top]),
+        np.column_stack([x_right, y_bottom]),
+        np.column_stack([x_left, y_bottom]),
+        np.column_stack([x_left, y_top]),
+    ], axis=1)
+    centres = np.column_stack([(x_left + x_right) / 2, (y_top + y_bottom) / 2])
+    return row * n_cols + col + 1, centres, rings
+
+
+def hex_cells(x0, y0, side, n_cols, row_start, row_stop):
+    """cell_id, centres (n, 2) and closed vertex rings (n, 7, 2) of flat-topped hexagons.
+
+    Centres are 1.5 * side apart across columns and sqrt(3) * side down
+    rows; odd columns are shifted down by half a row.
+    """
+    dx = 1.5 * side
+    dy = math.sqrt(3) * side
+    row, col = np.divmod(np.arange(row_start * n_cols, row_stop * n_cols), n_cols)
+    cx = x0 + col * dx
+    cy = y0 - (row * dy + np.where(col % 2 == 1, dy / 2, 0.0))
+    rings = np.stack([cx[:, None] + side * HEX_VERTICES[:, 0], cy[:, None] + side * HEX_VERTICES[:, 1]], axis=-1)
+    rings = np.concatenate([rings, rings[:, :1]], axis=1)
+    return row * n_cols + col + 1, np.column_stack([cx, cy]), rings
+
+
+def cells_touching(tree, rings):
+    """Boolean mask of the cells (vertex rings) that intersect a geometry in the shapely STRtree."""
+    cells, _ = tree.query(shapely.polygons(rings), predicate="intersects")
+    mask = np.zeros(len(rings), dtype=bool)
+    mask[cells] = True
+    return mask
+
+
+def cell_geometries(centres, rings, transformer=None):
+    """Polygons and centre points, reprojected with a single transformer.transform call.
+
+    transformer is a pyproj Transformer created with always_xy=True, or None
+    to keep the coordinates.
+    """
+    if transformer is not None:
+        xy = np.concatenate([centres, rings.reshape(-1, 2)])
+        x, y = transformer.transform(xy[:, 0], xy[:, 1])
+        xy = np.column_stack([x, y])
+        centres, rings = xy[:len(centres)], xy[len(centres):].reshape(rings.shape)
+    return shapely.polygons(rings), shapely.points(centres)
+
+
+def parent_ids(cell_id, n_cols, factor):
+    """cell_id of the enclosing cell in the grid of factor x factor blocks sharing the origin.
+
+    n_cols is the column count of the grid cell_id belongs to and must be a
+    multiple of factor.
+    """
+    row, col = np.divmod(np.asarray(cell_id) - 1, n_cols)
+    return (row // factor) * (n_cols // factor) + col // factor + 1
+
+
+def level_path(path, factor):
+    """Path of a grid pyramid level: grid.shp -> grid-x2.shp for factor 2, unchanged for factor 1."""
+    if factor == 1:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}-x{factor}{ext}"
+
+
+def roll_up_means(pairs, columns, parent):
+    """Mean of columns per coarse cell, from the (input feature, fine cell) pairs of a spatial join.
+
+    pairs is indexed by input feature and has a cell_id column; parent maps
+    fine cell_id to coarse cell_id (a Series). A feature that touches several
+    fine cells of one coarse cell counts once, as in a join on the coarse grid.
+    """
+    level_pairs = pairs[list(columns)].assign(cell_id=pairs["cell_id"].map(parent).to_numpy(), feature=pairs.index)
+    level_pairs = level_pairs.drop_duplicates(["feature", "cell_id"])
+    return level_pairs.groupby("cell_id")[list(columns)].mean().reset_index()
+
+
+# =============================
+# GRID MANIFEST
+# =============================
+# The generators store the lattice of each grid in a JSON file next to the
+# shapefile (grid.shp -> grid.json), in the projected CRS the cells were
+# built in. Points can then be assigned to cells arithmetically.
+def grid_manifest_path(grid_path):
+    """Path of the manifest of grid_path: grid.shp -> grid.json."""
+    return os.path.splitext(grid_path)[0] + ".json"
+
+
+def square_manifest(crs, x0, y0, cell_size, n_rows, n_cols):
+    """Manifest of a square grid with upper-left corner (x0, y0) in the projected crs."""
+    return {
+        "shape": "square",
+        "crs": CRS(crs).to_wkt(),
+        "origin": [float(x0), float(y0)],
+        "origin_at": "upper-left corner of cell_id 1",
+        "cell_size_m": float(cell_size),
+        "n_rows": int(n_rows),
+        "n_cols": int(n_cols),
+        "cell_id": "row * n_cols + col + 1",
+    }
+
+
+def hex_manifest(crs, x0, y0, side, n_rows, n_cols):
+    """Manifest of a flat-topped hex grid whose first centre is (x0, y0) in the projected crs."""
+    return {
+        "shape": "hex",
+        "orientation": "flat-topped, odd columns shifted down by dy / 2",
+        "crs": CRS(crs).to_wkt(),
+        "origin": [float(x0), float(y0)],
+        "origin_at": "centre of cell_id 1",
+        "side_m": float(side),
+        "dx_m": 1.5 * side,
+        "dy_m": math.sqrt(3) * side,
+        "n_rows": int(n_rows),
+        "n_cols": int(n_cols),
+        "cell_id": "row * n_cols + col + 1",
+    }
+
+
+def write_grid_manifest(grid_path, manifest):
+    with open(grid_manifest_path(grid_path), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_grid_manifest(grid_path):
+    path = grid_manifest_path(grid_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No grid manifest {path}. Re-run GRID-gen.py or HEX-gen.py to write it.")
+    with open(path) as f:
+        return json.load(f)
+
+
+def point_cell_ids(manifest, x, y):
+    """cell_id of the cell containing each point, 0 for points outside the grid.
+
+    x and y are coordinates in the manifest CRS. Square cells are found by
+    flooring; hexagons by converting to axial coordinates and rounding to
+    the nearest cube coordinate. A point on a shared edge goes to exactly
+    one cell: for squares the cell to its east or south (each cell owns
+    its left and top edges, so points on the grid's outer right and bottom
+    edges are outside); for hexagons the one picked by the cube rounding.
+    A join with predicate="intersects" counts such points in every
+    touching cell instead.
+    """
+    x0, y0 = manifest["origin"]
+    n_rows, n_cols = manifest["n_rows"], manifest["n_cols"]
+    px = np.asarray(x, dtype=float) - x0
+    py = y0 - np.asarray(y, dtype=float)  # rows count downwards
+    if manifest["shape"] == "square":
+        col = np.floor(px / manifest["cell_size_m"])
+        row = np.floor(py / manifest["cell_size_m"])
+    else:
+        side = manifest["side_m"]
+        q = (2 / 3) * px / side
+        r = (-px / 3 + math.sqrt(3) / 3 * py) / side
+        rq, rr, rs = np.round(q), np.round(r), np.round(-q - r)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs + q + r)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        # Axial to offset coordinates (odd columns shifted down)
+        col = rq
+        row = rr + (rq - np.mod(rq, 2)) / 2
+    inside = (col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows)
+    return np.where(inside, row * n_cols + col + 1, 0).astype(np.int64)
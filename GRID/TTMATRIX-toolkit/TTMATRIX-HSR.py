@@ -9,22 +9,63 @@ stations_file = "HSR-stations.shp"                                # Set to None
 network_file = "HSR-lines.shp"             # Network polyline shapefile
 point_id_field = "cell_id"                       # Identifier field in point shapefile
 walking_speed_kmh = 60                               # Walking speed (km/h)
+walk_station_k = 3                                   # Number of nearest stations each point is linked to by walking edges
+walk_neighbor_k = 5                                  # Number of nearest neighboring points each point is linked to by walking edges
 network_speed_kmh = 150                              # Network speed (km/h)
+scenario_speeds_kmh = {"noHSR": 33, "HSR": 150}     # Optional batch mode, e.g. {"noHSR": 33, "HSR": 150, "HSR200": 200}; overrides network_speed_kmh
+scenario_output_prefix = "TTMATRIX-HSR"              # Batch mode output names: <prefix>-<scenario>.csv/.shp and graph_edges-<prefix>-<scenario>.shp
+delta_baseline_scenario = "noHSR"                    # Batch mode: also save the OD pairs whose time differs from this scenario (<prefix>-<scenario>-delta.csv); None = off
+delta_tolerance_min = 1e-6                           # Minimum change (minutes) for an OD pair to count as changed
+delta_only = False                                   # Batch mode: for scenarios other than the baseline save only the delta, not the full matrix
+delta_formats = ["csv"]                              # "csv" (plus <...>-delta_origins.csv change mask per origin) and/or "mat"
 snap_tolerance_m = 1.0                              # Tolerance for snapping network segment endpoints (meters)
+node_precision_m = 0.001                            # Network vertices that round to the same multiple of this (meters) become one node
+network_speed_field = None                          # Optional network field with a speed per line (km/h); lines without a positive value use the network/scenario speed
 output_matrix_file = "TTMATRIX-HSR-HSR.csv"            # Output travel time matrix CSV
+output_matrix_formats = ["csv"]                      # Any of "csv", "npy" (memory-mappable, with _ids.csv sidecar), "mat" (MATLAB), "tiles" (chunked .npy folder)
+matrix_dtype = "float64"                             # Numeric precision of the travel time matrix ("float64" or "float32" to halve memory)
+matrix_memory_budget_gb = None                       # Tiled mode: stream origin blocks to disk within this budget (GB) instead of holding the full matrix; not with "mat"
+max_travel_time_min = None                           # Cutoff (minutes): searches stop here and only pairs within reach are saved as sparse triplets; None = full matrix
+sparse_matrix_formats = ["csv"]                      # With a cutoff, any of "csv"/"mat" (1-based row, col, time_min for MATLAB sparse()) or "npz" (SciPy CSR)
+# --- Accessibility measures (added to the output shapefile, folded row by row; tiled mode with output_matrix_formats = [] stores no matrix) ---
+population_field = "pop"                             # Point field for population-weighted mean travel times (pop_wtime); None = skip
+employment_field = "emp"                             # Point field for employment-weighted mean times (emp_wtime), jobs within reach and market access; None = skip
+jobs_within_min = [30, 45, 60]                       # Jobs reachable within these travel times in minutes (emp_30min, ...)
+market_access_decay = 0.05                           # Decay per minute of market access sum_j emp_j * exp(-decay * t_ij) (mkt_access); None = skip
 output_shapefile = "TTMATRIX-HSR-HSR.shp"                   # Output shapefile with average travel times
 output_edges_shapefile = "graph_edges-TTMATRIX-HSR-HSR.shp"     # Output shapefile showing the graph (network + walking) used in Dijkstra
+export_edges = "all"                                 # Edges to export: "all", "transit" (network only) or None to skip the export
+output_edges_format = "shp"                          # "shp", "fgb" (FlatGeobuf, no 2 GB limit) or "parquet" (GeoParquet, installs pyarrow)
+# --- Station placement search (the stations are the candidate pool; replaces the scenario runs) ---
+placement_layout_size = None                         # Stations per layout, e.g. 2; None = off
+placement_max_layouts = 2000                         # All layouts if there are at most this many, otherwise this many random ones
+placement_weight_field = "pop"                       # Point field weighting origins and destinations in the objective; None = unweighted
+placement_top_k = 3                                  # Save the travel time matrices of the k best layouts (<prefix>-placement-<rank>)
+placement_seed = 0                                   # Seed for the random layouts
 # --- Only relevant if no station shapefile is progided ---
 cluster_eps_m = 200                                 # Max distance between points in a cluster for artificial stations (meters)
+station_clustering = "dbscan"                       # "dbscan" or "grid" (grid-hash into cluster_eps_m cells; much faster for regular grids of points)
+# --- Routing ---
+routing_backend = "scipy"                           # "scipy" (compiled sparse Dijkstra), "skim" (walking legs + station skim, fastest for many scenarios) or "networkx" (reference implementation)
+# --- Spatial window (points, stations and network are filtered when they are read) ---
+window = None                                       # (minx, miny, maxx, maxy) in window_crs or a polygon file in the input folder; None = everything
+window_crs = None                                   # CRS of a bounding-box window, e.g. "EPSG:4326"; None = CRS of the points file
+window_buffer_m = 20000                             # Stations and network are also read this far beyond the window so routes near its edge stay correct
 # --- Optional for debugging ---
 debug_limit_points = None                           # Set to e.g. 1000 to limit to first N points for testing
+contract_transit_chains = False                     # Opt-in: collapse degree-2 network nodes into single edges before routing (smaller graph; fewer exported edges, times equal up to ~4e-14 min)
+n_workers = 1                                       # Number of processes for the travel time matrix (1 = serial)
+use_graph_cache = True                              # Reuse the routing graph from the cache folder when inputs and graph settings are unchanged
 
 
 # === PACKAGE INSTALLATION ===
 def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-for pkg in ["geopandas", "shapely", "tqdm", "matplotlib", "networkx", "pandas", "numpy", "pyproj", "scipy", "scikit-learn"]:
+packages = ["geopandas", "shapely", "tqdm", "matplotlib", "networkx", "pandas", "numpy", "pyproj", "scipy", "scikit-learn"]
+if output_edges_format == "parquet":
+    packages.append("pyarrow")  # GeoParquet writer
+for pkg in packages:
     try:
         __import__(pkg)
     except ImportError:
@@ -32,28 +73,71 @@ for pkg in ["geopandas", "shapely", "tqdm", "matplotlib", "networkx", "pandas",
 
 # === IMPORTS ===
 import geopandas as gpd
-from shapely.geometry import LineString, Point
-from tqdm import tqdm
 import matplotlib.pyplot as plt
-import networkx as nx
 import pandas as pd
 import numpy as np
 from pyproj import CRS
+from shapely import box, union_all
 from scipy.spatial import cKDTree
-from shapely.ops import split
 from sklearn.cluster import DBSCAN
+from ttmatrix_engine import (
+    EDGE_FORMATS, AccessibilityReducer, RoutingGraph, ScenarioDelta, StationPlacement, candidate_layouts,
+    cluster_centroids, compute_sparse_travel_times, compute_travel_time_matrix, graph_cache_key, grid_hash_labels,
+    load_routing_graph, nearest_links, network_segments, project_to_nearest_lines, save_routing_graph,
+    snap_line_endpoints, split_lines_at_points, stream_travel_time_matrix
+)
+
+# Matrix output is shared with the GRID-toolkit (GRID/matrix_io.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matrix_io import TiledMatrix, save_matrix, save_sparse_matrix
+
+# === CHECK SETTINGS ===
+# Fail before any routing, not after the first scenario's outputs are written
+if output_edges_format not in EDGE_FORMATS:
+    raise ValueError(f"Unknown output_edges_format '{output_edges_format}'. Choose one of {EDGE_FORMATS}.")
+if output_edges_format == "parquet":
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("output_edges_format = 'parquet' needs pyarrow (pip install pyarrow).") from None
+if max_travel_time_min is not None and employment_field is not None and jobs_within_min:
+    # Pairs beyond the cutoff are never found, so a larger threshold would silently count too few jobs
+    if max(jobs_within_min) > max_travel_time_min:
+        raise ValueError(f"jobs_within_min {jobs_within_min} exceeds max_travel_time_min = {max_travel_time_min}. "
+                         "Raise the cutoff or drop the larger thresholds.")
 
 # === SET PATHS ===
 input_dir = os.path.join(working_dir, "input")
 output_dir = os.path.join(working_dir, "output")
+cache_dir = os.path.join(working_dir, "cache")
 os.makedirs(output_dir, exist_ok=True)
 
 points_path = os.path.join(input_dir, points_file)
 stations_path = os.path.join(input_dir, stations_file) if stations_file else None
 network_path = os.path.join(input_dir, network_file)
 
+# === SPATIAL WINDOW ===
+def window_mask(window, crs, buffer_m=0):
+    """Window polygon as a one-element GeoSeries for read_file(mask=...), buffered by buffer_m meters."""
+    if isinstance(window, str):
+        shapes = gpd.read_file(window)
+        mask = gpd.GeoSeries([union_all(shapes.geometry.values)], crs=shapes.crs)
+    else:
+        mask = gpd.GeoSeries([box(*window)], crs=crs)
+    if buffer_m:
+        metric_crs = mask.crs if mask.crs.is_projected else mask.estimate_utm_crs()
+        mask = mask.to_crs(metric_crs).buffer(buffer_m).to_crs(mask.crs)
+    return mask
+
+window_path = os.path.join(input_dir, window) if isinstance(window, str) else None
+points_window = network_window = None
+if window is not None:
+    points_window = window_mask(window_path or window, window_crs or gpd.read_file(points_path, rows=0).crs)
+    network_window = window_mask(window_path or window, points_window.crs, window_buffer_m)
+    print(f"Reading points within the window and stations/network within {window_buffer_m} m of it...")
+
 # === LOAD DATA ===
-points = gpd.read_file(points_path)
+points = gpd.read_file(points_path, mask=points_window)
 if debug_limit_points is not None:
     print(f"Limiting points to the first {debug_limit_points} for testing...")
     points = points.iloc[:debug_limit_points].copy()
@@ -63,8 +147,6 @@ if points.geom_type.isin(["Polygon", "MultiPolygon"]).any():
     print("Converting polygons to centroids...")
     points["geometry"] = points.centroid
 
-network = gpd.read_file(network_path)
-
 # === CHECK & ALIGN CRS ===
 if not points.crs.is_projected:
     print(f"Input CRS: {points.crs}")
@@ -79,251 +161,333 @@ if not points.crs.is_projected:
     print(f"Reprojecting to UTM zone {zone_number}, EPSG:{epsg_code}")
 
     points = points.to_crs(best_utm_crs)
-    network = network.to_crs(best_utm_crs)
-else:
-    network = network.to_crs(points.crs)
 
-# === HANDLE STATIONS: load or generate ===
-def generate_artificial_stations(points, network, eps=200):
-    print("No station shapefile found. Generating artificial stations using DBSCAN clustering...")
-
-    coords = np.array([[geom.x, geom.y] for geom in points.geometry])
-    clustering = DBSCAN(eps=eps, min_samples=1).fit(coords)
-    labels = clustering.labels_
-    centroids = []
-
-    for label in np.unique(labels):
-        cluster_coords = coords[labels == label]
-        centroid_xy = cluster_coords.mean(axis=0)
-        centroid_point = Point(centroid_xy)
+# === ARTIFICIAL STATIONS (IF NO STATION SHAPEFILE) ===
+def generate_artificial_stations(points, network, eps=200, method="dbscan"):
+    coords = np.column_stack([points.geometry.x, points.geometry.y])
+    if method == "grid":
+        print("No station shapefile found. Generating artificial stations using grid-hash clustering...")
+        labels = grid_hash_labels(coords, eps)
+    else:
+        print("No station shapefile found. Generating artificial stations using DBSCAN clustering...")
+        labels = DBSCAN(eps=eps, min_samples=1).fit(coords).labels_
 
-        distances = network.geometry.distance(centroid_point)
-        nearest_idx = distances.idxmin()
-        nearest_line = network.geometry.loc[nearest_idx]
-        projected = nearest_line.interpolate(nearest_line.project(centroid_point))
-        centroids.append(projected)
+    centroids = cluster_centroids(coords, labels)
+    projected = project_to_nearest_lines(centroids, network.geometry.values)
 
-    stations = gpd.GeoDataFrame(geometry=centroids, crs=points.crs)
+    stations = gpd.GeoDataFrame(geometry=projected, crs=points.crs)
     print(f"Generated {len(stations)} artificial stations.")
     return stations
 
-if stations_path and os.path.exists(stations_path):
-    stations = gpd.read_file(stations_path).to_crs(points.crs)
+# === LOAD CACHED ROUTING GRAPH IF INPUTS AND SETTINGS ARE UNCHANGED ===
+graph_settings = {
+    "snap_tolerance_m": snap_tolerance_m,
+    "node_precision_m": node_precision_m,
+    "network_speed_field": network_speed_field,
+    "cluster_eps_m": cluster_eps_m,
+    "station_clustering": station_clustering,
+    "walk_station_k": walk_station_k,
+    "walk_neighbor_k": walk_neighbor_k,
+    "debug_limit_points": debug_limit_points,
+    "window": window,
+    "window_crs": window_crs,
+    "window_buffer_m": window_buffer_m,
+    "contract_transit_chains": contract_transit_chains,
+}
+cache_path = os.path.join(cache_dir, "graph-" + graph_cache_key([points_path, stations_path, network_path, window_path], graph_settings) + ".npz")
+cached = load_routing_graph(cache_path) if use_graph_cache else None
+
+if cached is not None:
+    routing_graph, station_nodes, _ = cached
+    print(f"Loaded cached routing graph ({len(routing_graph.nodes)} nodes, {len(routing_graph.edge_u)} edges) from: {cache_path}")
 else:
-    stations = generate_artificial_stations(points, network, eps=cluster_eps_m)
-
-print(f"Loaded {len(points)} points")
-print(f"Loaded {len(stations)} stations")
-print(f"Loaded {len(network)} network elements")
-
-# === SNAP NEARBY ENDPOINTS IN NETWORK ===
-if snap_tolerance_m > 0:
-    print(f"Snapping nearby network segment endpoints within {snap_tolerance_m} meter(s)...")
-
-    endpoints = []
-    for geom in network.geometry:
-        coords = list(geom.coords)
-        if len(coords) >= 2:
-            endpoints.append(Point(coords[0]))
-            endpoints.append(Point(coords[-1]))
-
-    endpoint_coords = np.array([[pt.x, pt.y] for pt in endpoints])
-    endpoint_kdtree = cKDTree(endpoint_coords)
-    snapped_coords = endpoint_coords.copy()
-    visited = set()
-
-    for i in range(len(endpoint_coords)):
-        if i in visited:
-            continue
-        idxs = endpoint_kdtree.query_ball_point(endpoint_coords[i], r=snap_tolerance_m)
-        if len(idxs) > 1:
-            visited.update(idxs)
-            cluster_pts = endpoint_coords[idxs]
-            centroid = cluster_pts.mean(axis=0)
-            for idx in idxs:
-                snapped_coords[idx] = centroid
-
-    coord_map = {tuple(pt): tuple(snapped_coords[i]) for i, pt in enumerate(endpoint_coords)}
-
-    def snap_coords(coords):
-        return [coord_map.get(tuple(c), c) for c in coords]
-
-    snapped_geoms = []
-    for geom in network.geometry:
-        coords = list(geom.coords)
-        new_coords = snap_coords(coords)
-        snapped_geoms.append(LineString(new_coords))
-
-    network["geometry"] = snapped_geoms
-    print("Finished snapping network endpoints.")
-
-# === SPLIT NETWORK SEGMENTS AT STATION LOCATIONS IF THEY PASS THROUGH ===
-print("Splitting network lines at stations if they pass through...")
-
-station_buffer = stations.copy()
-station_buffer["geometry"] = station_buffer.buffer(0.5)
-
-new_geoms = []
-
-for line in tqdm(network.geometry, desc="Splitting lines"):
-    intersecting_stations = station_buffer[station_buffer.intersects(line)]
-
-    if intersecting_stations.empty:
-        new_geoms.append(line)
+    network = gpd.read_file(network_path, mask=network_window).to_crs(points.crs)
+
+    # === HANDLE STATIONS: load or generate ===
+    if stations_path and os.path.exists(stations_path):
+        stations = gpd.read_file(stations_path, mask=network_window).to_crs(points.crs)
     else:
-        splitters = intersecting_stations["geometry"].union_all()
-        try:
-            result = split(line, splitters)
-            for segment in result.geoms:
-                if segment.length > 0:
-                    new_geoms.append(segment)
-        except Exception as e:
-            print(f"Warning: could not split line: {e}")
-            new_geoms.append(line)
-
-network = gpd.GeoDataFrame(geometry=new_geoms, crs=points.crs)
-print(f"Finished splitting. Network now has {len(network)} segments.")
-
-# === BUILD AUGMENTED GRAPH ===
-print("Building augmented graph with transit + walking...")
-
-G_aug = nx.Graph()
-
-# Add transit network edges
-for idx, row in network.iterrows():
-    coords = list(row.geometry.coords)
-    for i in range(len(coords) - 1):
-        u, v = coords[i], coords[i + 1]
-        segment = LineString([u, v]).length
-        time = (segment / 1000) / network_speed_kmh * 60
-        G_aug.add_edge(u, v, weight=time)
-
-# Add station nodes
-for idx, row in stations.iterrows():
-    G_aug.add_node(f"station_{idx}", geometry=row.geometry)
-
-# === CONNECT STATIONS TO TRANSIT NETWORK ===
-print("Connecting stations to nearest transit network node...")
-
-network_nodes = [n for n in G_aug.nodes if isinstance(n, tuple)]
-network_node_points = [Point(n) for n in network_nodes]
-network_kdtree = cKDTree(np.array([[pt.x, pt.y] for pt in network_node_points]))
-
-for idx, row in tqdm(stations.iterrows(), total=len(stations), desc="Snapping stations"):
-    station_name = f"station_{idx}"
-    station_coord = np.array([row.geometry.x, row.geometry.y])
-    _, nearest_idx = network_kdtree.query(station_coord, k=1)
-    nearest_node = network_nodes[nearest_idx]
-    G_aug.add_edge(station_name, nearest_node, weight=0.0001)
-
-# Add point nodes
-for idx, row in points.iterrows():
-    G_aug.add_node(f"point_{idx}", geometry=row.geometry)
-
-# === CONNECT POINTS TO NEAREST STATIONS ===
-print("Adding walking edges from points to their 3 nearest stations...")
-
-station_coords = np.array([[geom.x, geom.y] for geom in stations.geometry])
-station_kdtree = cKDTree(station_coords)
-
-point_coords = np.array([[geom.x, geom.y] for geom in points.geometry])
-
-for i in tqdm(range(len(points)), desc="Point-to-station edges"):
-    distances, indices = station_kdtree.query(point_coords[i], k=3)
-    p_node = f"point_{i}"
-    for dist_m, j in zip(distances, indices):
-        s_node = f"station_{j}"
-        time_min = (dist_m / 1000) / walking_speed_kmh * 60
-        G_aug.add_edge(p_node, s_node, weight=time_min)
-
-# === ADD WALKING EDGES TO NEAREST NEIGHBORS ONLY ===
-print("Adding walking edges to 5 nearest neighbors per point...")
-
-point_kdtree = cKDTree(point_coords)
-
-for i in tqdm(range(len(points)), desc="Point-to-point nearest neighbors"):
-    distances, neighbors = point_kdtree.query(point_coords[i], k=6)
-    p_node_i = f"point_{i}"
-    for neighbor_idx, distance_m in zip(neighbors[1:], distances[1:]):
-        p_node_j = f"point_{neighbor_idx}"
-        time_min = (distance_m / 1000) / walking_speed_kmh * 60
-        G_aug.add_edge(p_node_i, p_node_j, weight=time_min)
-
-# === COMPUTE TRAVEL TIME MATRIX (SERIAL) ===
-print("Computing travel time matrix (serial)...")
-matrix = pd.DataFrame(index=points.index, columns=points.index)
-
-for i in tqdm(points.index, desc="Dijkstra"):
-    source = f"point_{i}"
-    lengths = nx.single_source_dijkstra_path_length(G_aug, source, weight='weight')
-    for j in points.index:
-        target = f"point_{j}"
-        matrix.at[i, j] = lengths.get(target, np.nan)
-
-# === ASSIGN ID LABELS WITH PREFIX TO MATRIX ===
+        stations = generate_artificial_stations(points, network, eps=cluster_eps_m, method=station_clustering)
+
+    print(f"Loaded {len(points)} points")
+    print(f"Loaded {len(stations)} stations")
+    print(f"Loaded {len(network)} network elements")
+
+    # === SNAP NEARBY ENDPOINTS IN NETWORK ===
+    if snap_tolerance_m > 0:
+        print(f"Snapping nearby network segment endpoints within {snap_tolerance_m} meter(s)...")
+        network["geometry"] = snap_line_endpoints(network.geometry.values, snap_tolerance_m)
+        print("Finished snapping network endpoints.")
+
+    # === SPLIT NETWORK SEGMENTS AT STATION LOCATIONS IF THEY PASS THROUGH ===
+    print("Splitting network lines at stations if they pass through...")
+
+    new_geoms, source_line = split_lines_at_points(
+        network.geometry.values, stations.geometry.values, buffer_m=0.5, return_index=True
+    )
+    line_speeds = None
+    if network_speed_field:
+        line_speeds = pd.to_numeric(network[network_speed_field], errors="coerce").to_numpy(dtype=float)
+        line_speeds = np.where(line_speeds > 0, line_speeds, np.nan)[source_line]
+    network = gpd.GeoDataFrame(geometry=new_geoms, crs=points.crs)
+    print(f"Finished splitting. Network now has {len(network)} segments.")
+
+    # === BUILD AUGMENTED GRAPH ===
+    print("Building augmented graph with transit + walking...")
+
+    # Add transit network edges (all segments at once, vertices deduplicated on a node_precision_m grid)
+    node_xy, seg_u, seg_v, seg_length_m, seg_speed_kmh = network_segments(
+        network.geometry.values, node_precision_m, speeds=line_speeds
+    )
+    routing_graph = RoutingGraph.from_segments(node_xy, seg_u, seg_v, seg_length_m, seg_speed_kmh, network_speed_kmh)
+    print(f"Transit network: {len(node_xy)} nodes, {len(seg_u)} segments.")
+
+    # Add station nodes
+    station_nodes = [f"station_{idx}" for idx in stations.index]
+    station_coords = np.column_stack([stations.geometry.x, stations.geometry.y])
+    station_ids = routing_graph.add_nodes(station_nodes, station_coords)
+
+    # === CONNECT STATIONS TO TRANSIT NETWORK ===
+    print("Connecting stations to nearest transit network node...")
+
+    _, nearest_idx = cKDTree(node_xy).query(station_coords, k=1)
+    routing_graph.add_edges(station_ids, nearest_idx, np.full(len(station_ids), 0.0001), np.nan, kind="link")
+
+    # === CONTRACT DEGREE-2 TRANSIT CHAINS ===
+    # Junctions and station attachment nodes stay; chain polylines are kept for the edge export only
+    if contract_transit_chains:
+        n_before = len(routing_graph.nodes)
+        routing_graph = routing_graph.contract_transit_chains(keep=station_nodes)
+        print(f"Contracted transit chains: {n_before} -> {len(routing_graph.nodes)} nodes, "
+              f"{len(routing_graph.edge_u)} edges.")
+
+    # Add point nodes
+    point_coords = np.column_stack([points.geometry.x, points.geometry.y])
+    point_ids = routing_graph.add_nodes([f"point_{idx}" for idx in points.index], point_coords)
+    station_ids = np.array([routing_graph.node_ids[name] for name in station_nodes], dtype=np.int64)
+
+    # === CONNECT POINTS TO NEAREST STATIONS ===
+    print(f"Adding walking edges from points to their {walk_station_k} nearest stations...")
+
+    src, dst, dist_m = nearest_links(point_coords, station_coords, walk_station_k)
+    routing_graph.add_edges(point_ids[src], station_ids[dst], (dist_m / 1000) / walking_speed_kmh * 60,
+                            dist_m, kind="walk")
+
+    # === ADD WALKING EDGES TO NEAREST NEIGHBORS ONLY ===
+    print(f"Adding walking edges to {walk_neighbor_k} nearest neighbors per point...")
+
+    src, dst, dist_m = nearest_links(point_coords, point_coords, walk_neighbor_k, exclude_self=True)
+    routing_graph.add_edges(point_ids[src], point_ids[dst], (dist_m / 1000) / walking_speed_kmh * 60,
+                            dist_m, kind="walk")
+
+    # Node indexing and walking/access edges are shared by all scenarios;
+    # only the transit edge weights are rescaled per scenario.
+    if use_graph_cache:
+        save_routing_graph(cache_path, routing_graph, station_nodes, points.crs)
+        print(f"Saved routing graph to cache: {cache_path}")
+
+# Walking edges are re-weighted, so walking_speed_kmh does not invalidate the cache
+routing_graph.set_walking_speed(walking_speed_kmh)
+point_nodes = [f"point_{i}" for i in points.index]
+
+
+# === DEFINE SCENARIOS (ONE GRAPH, MANY NETWORK SPEEDS) ===
+if scenario_speeds_kmh:
+    scenarios = {
+        name: (
+            speed,
+            f"{scenario_output_prefix}-{name}.csv",
+            f"{scenario_output_prefix}-{name}.shp",
+            f"graph_edges-{scenario_output_prefix}-{name}.shp",
+        )
+        for name, speed in scenario_speeds_kmh.items()
+    }
+else:
+    scenarios = {
+        os.path.splitext(output_matrix_file)[0]: (network_speed_kmh, output_matrix_file, output_shapefile, output_edges_shapefile)
+    }
+
 if point_id_field not in points.columns:
     raise ValueError(f"ID field '{point_id_field}' not found in points file.")
 
-id_labels = points[point_id_field].astype(str).values
-row_labels = [point_id_field + str(val) for val in id_labels]
-matrix.index = row_labels
-matrix.columns = row_labels
-
-# === SAVE MATRIX TO CSV ===
-output_csv = os.path.join(output_dir, output_matrix_file)
-matrix.to_csv(output_csv, index_label=point_id_field)
-print(f"Saved matrix to: {output_csv}")
-
-# === COMPUTE MEAN TRAVEL TIME ===
-mean_travel_times = matrix.mean(axis=1, skipna=True)
-points["mean_time_min"] = pd.to_numeric(mean_travel_times.values, errors='coerce').astype("float64")
-
-# === SAVE POINTS WITH MEAN TIME ===
-points_out_path = os.path.join(output_dir, output_shapefile)
-points.to_file(points_out_path)
-print(f"Saved enriched points with mean travel times to: {points_out_path}")
-
-# === EXPORT ALL GRAPH EDGES AS SHAPEFILE (INCLUDING POINT & STATION LINKS) ===
-print("Exporting full graph edges (network + walking) as shapefile...")
-
-edge_records = []
+accessibility_weights = {}
+for field in (population_field, employment_field):
+    if field:
+        if field not in points.columns:
+            raise ValueError(f"Accessibility field '{field}' not found in points file.")
+        accessibility_weights[field] = points[field].fillna(0).to_numpy()
+
+# === STATION PLACEMENT SEARCH (OPTIONAL) ===
+if placement_layout_size:
+    print(f"\n=== STATION PLACEMENT: layouts of {placement_layout_size} out of {len(station_nodes)} candidate stations ===")
+    if placement_layout_size > len(station_nodes):
+        raise ValueError(f"placement_layout_size ({placement_layout_size}) exceeds the {len(station_nodes)} candidate stations.")
+    if placement_weight_field and placement_weight_field not in points.columns:
+        raise ValueError(f"Placement weight field '{placement_weight_field}' not found in points file.")
+    routing_graph.set_network_speed(network_speed_kmh)
+    placement = StationPlacement(
+        routing_graph, point_nodes, station_nodes, n_workers=n_workers,
+        weights=points[placement_weight_field].fillna(0).to_numpy() if placement_weight_field else None
+    )
+    layouts = candidate_layouts(len(station_nodes), placement_layout_size, placement_max_layouts, seed=placement_seed)
+    print(f"Scoring {len(layouts)} layouts...")
+    ranking = placement.rank(layouts)
+
+    # Layouts are listed by the station shapefile index of their stations
+    station_index = [name.removeprefix("station_") for name in station_nodes]
+    ranking["stations"] = [" ".join(station_index[k] for k in layout) for layout in ranking["layout"]]
+    placement_base = os.path.join(output_dir, f"{scenario_output_prefix}-placement")
+    ranking.drop(columns="layout").to_csv(placement_base + ".csv", index=False)
+    print(f"Walking only: {placement.walk_only:.2f} min; best layout (stations {ranking['stations'].iloc[0]}): "
+          f"{ranking['wmean_time_min'].iloc[0]:.2f} min")
+    print(f"Saved layout ranking to: {placement_base}.csv")
+
+    # === SAVE MATRICES OF THE TOP LAYOUTS ===
+    row_labels = [point_id_field + val for val in points[point_id_field].astype(str).values]
+    for rank, layout in zip(ranking["rank"].iloc[:placement_top_k], ranking["layout"]):
+        travel_times = placement.travel_times(layout).astype(matrix_dtype)
+        for path in save_matrix(travel_times, points[point_id_field].values, f"{placement_base}-{rank}",
+                                output_matrix_formats, point_id_field, row_labels=row_labels):
+            print(f"Saved matrix to: {path}")
+        del travel_times
+    scenarios = {}  # Placement mode writes no scenario outputs
+
+# === BASELINE FOR SCENARIO DELTAS (BATCH MODE) ===
+use_delta = bool(scenarios) and bool(scenario_speeds_kmh) and delta_baseline_scenario is not None
+if use_delta:
+    if delta_baseline_scenario not in scenarios:
+        raise ValueError(f"Delta baseline '{delta_baseline_scenario}' is not one of the scenarios {list(scenarios)}.")
+    # Route the baseline first so every other scenario can be compared against it
+    scenarios = {delta_baseline_scenario: scenarios.pop(delta_baseline_scenario), **scenarios}
+    baseline_base = os.path.join(output_dir, os.path.splitext(scenarios[delta_baseline_scenario][1])[0])
+baseline_times = None
+
+for scenario, (speed_kmh, matrix_file, shapefile, edges_shapefile) in scenarios.items():
+    print(f"\n=== SCENARIO {scenario}: network speed {speed_kmh} km/h ===")
+    routing_graph.set_network_speed(speed_kmh)
+
+    # === ASSIGN ID LABELS WITH PREFIX TO MATRIX ===
+    id_labels = points[point_id_field].astype(str).values
+    row_labels = [point_id_field + str(val) for val in id_labels]
+    output_base = os.path.join(output_dir, os.path.splitext(matrix_file)[0])
+    mode = "serial" if n_workers <= 1 else f"parallel, {n_workers} workers"
+    is_baseline = use_delta and scenario == delta_baseline_scenario
+    delta = ScenarioDelta(len(point_nodes), delta_tolerance_min) if use_delta and not is_baseline else None
+    save_full = delta is None or not delta_only
+    accessibility = AccessibilityReducer(len(point_nodes), weights=accessibility_weights, jobs_field=employment_field,
+                                         thresholds_min=jobs_within_min, decay=market_access_decay)
+
+    if max_travel_time_min is not None:
+        # === CUTOFF MODE: ONLY PAIRS WITHIN max_travel_time_min, SAVED AS SPARSE TRIPLETS ===
+        print(f"Computing travel times up to {max_travel_time_min} minutes ({mode}, {routing_backend} backend)...")
+        travel_times = compute_sparse_travel_times(
+            routing_graph, point_nodes, max_travel_time_min, backend=routing_backend, n_workers=n_workers,
+            dtype=matrix_dtype, station_nodes=station_nodes
+        )
+        print(f"{travel_times.nnz} of {len(point_nodes) ** 2} pairs within {max_travel_time_min} minutes")
+        matrix_paths = []
+        if save_full:
+            matrix_paths = save_sparse_matrix(travel_times, points[point_id_field].values, output_base + "_sparse",
+                                              sparse_matrix_formats, point_id_field, value_name="time_min")
+        if delta is not None:
+            delta.add_sparse(baseline_times, travel_times)
+        # Means are taken over the destinations within the cutoff
+        accessibility.set_sparse(travel_times)
+        if is_baseline:
+            baseline_times = travel_times
+        del travel_times
+    elif matrix_memory_budget_gb:
+        # === TILED MODE: STREAM ORIGIN BLOCKS TO DISK, ACCESSIBILITY FOLDED PER BLOCK ===
+        print(f"Computing travel time matrix in tiled mode ({mode}, {routing_backend} backend)...")
+        if delta is not None:
+            # The baseline matrix is read back from disk block by block
+            if "npy" in output_matrix_formats:
+                baseline_times = np.load(baseline_base + ".npy", mmap_mode="r")
+            elif "tiles" in output_matrix_formats:
+                baseline_times = TiledMatrix(baseline_base + ".tiles")
+            else:
+                raise ValueError("Scenario deltas in tiled mode need 'npy' or 'tiles' in output_matrix_formats.")
+
+        def fold_block(start, block):
+            accessibility.set_rows(start, block)
+            if delta is not None:
+                delta.add(start, baseline_times[start:start + len(block)], block)
+
+        matrix_paths = stream_travel_time_matrix(
+            routing_graph, point_nodes, points[point_id_field].values, output_base,
+            output_matrix_formats if save_full else [], point_id_field, matrix_memory_budget_gb * 1e9,
+            backend=routing_backend, n_workers=n_workers, dtype=matrix_dtype, station_nodes=station_nodes,
+            row_labels=row_labels, on_block=fold_block
+        )
+    else:
+        # === COMPUTE TRAVEL TIME MATRIX (SERIAL OR PARALLEL) ===
+        print(f"Computing travel time matrix ({mode}, {routing_backend} backend)...")
+        travel_times = compute_travel_time_matrix(
+            routing_graph, point_nodes, backend=routing_backend, n_workers=n_workers, dtype=matrix_dtype,
+            station_nodes=station_nodes
+        )
+
+        # === SAVE MATRIX (CSV / NPY / MAT / TILES) ===
+        matrix_paths = []
+        if save_full:
+            matrix_paths = save_matrix(travel_times, points[point_id_field].values, output_base,
+                                       output_matrix_formats, point_id_field, row_labels=row_labels)
+        if delta is not None:
+            delta.add(0, baseline_times, travel_times)
+        accessibility.set_rows(0, travel_times)
+        if is_baseline:
+            baseline_times = travel_times
+        del travel_times
+
+    # === SAVE OD PAIRS THAT CHANGED AGAINST THE BASELINE ===
+    if delta is not None:
+        print(f"{len(delta.pairs()[0])} OD pairs from {delta.changed_origins.sum()} origins changed "
+              f"against {delta_baseline_scenario}")
+        matrix_paths += delta.save(output_base + "-delta", points[point_id_field].values, point_id_field, delta_formats)
+
+    for path in matrix_paths:
+        print(f"Saved matrix to: {path}")
+
+    # === MEAN TRAVEL TIME AND ACCESSIBILITY MEASURES ===
+    for column, values in accessibility.results().items():
+        points[column] = values.to_numpy()
+
+    # === SAVE POINTS WITH MEAN TIME AND ACCESSIBILITY ===
+    points_out_path = os.path.join(output_dir, shapefile)
+    points.to_file(points_out_path)
+    print(f"Saved enriched points with mean travel times to: {points_out_path}")
+
+    # === EXPORT GRAPH EDGES (NETWORK + WALKING, OR TRANSIT ONLY) ===
+    if export_edges:
+        print(f"Exporting graph edges ({export_edges}) as {output_edges_format}...")
+        edges_gdf = gpd.GeoDataFrame(
+            routing_graph.edge_frame(kinds=None if export_edges == "all" else [export_edges]), crs=points.crs
+        )
+        edges_out_path = os.path.join(output_dir, os.path.splitext(edges_shapefile)[0] + "." + output_edges_format)
+        if output_edges_format == "parquet":
+            edges_gdf.to_parquet(edges_out_path)
+        else:
+            edges_gdf.to_file(edges_out_path)
+        print(f"Saved graph edges to: {edges_out_path}")
+
+    # === PLOT MEAN TRAVEL TIME MAP ===
+    fig, ax = plt.subplots(figsize=(10, 10))
+    points.plot(
+        column="mean_time_min",
+        ax=ax,
+        legend=True,
+        cmap="viridis",
+        markersize=60,
+        edgecolor="black",
+        linewidth=0.2
+    )
+    plt.title(f"Mean Travel Time from Each Origin (minutes), {scenario}")
+    plt.tight_layout()
+
+    # === STATISTICS FOR MEAN TRAVEL TIMES ===
+    print("\nMean travel time statistics (in minutes):")
+    print(f"Mean: {points['mean_time_min'].mean():.2f}")
+    print(f"Min:  {points['mean_time_min'].min():.2f}")
+    print(f"Max:  {points['mean_time_min'].max():.2f}")
 
-for u, v, data in G_aug.edges(data=True):
-    try:
-        geom_u = Point(u) if isinstance(u, tuple) else G_aug.nodes[u]["geometry"]
-        geom_v = Point(v) if isinstance(v, tuple) else G_aug.nodes[v]["geometry"]
-        line = LineString([geom_u, geom_v])
-        edge_records.append({
-            "from_node": str(u),
-            "to_node": str(v),
-            "time_min": data["weight"],
-            "geometry": line
-        })
-    except Exception as e:
-        print(f"Skipped edge ({u}, {v}): {e}")
-
-edges_gdf = gpd.GeoDataFrame(edge_records, crs=points.crs)
-edges_out_path = os.path.join(output_dir, output_edges_shapefile)
-edges_gdf.to_file(edges_out_path)
-print(f"Saved graph edges to: {edges_out_path}")
-
-# === PLOT MEAN TRAVEL TIME MAP ===
-fig, ax = plt.subplots(figsize=(10, 10))
-points.plot(
-    column="mean_time_min",
-    ax=ax,
-    legend=True,
-    cmap="viridis",
-    markersize=60,
-    edgecolor="black",
-    linewidth=0.2
-)
-plt.title("Mean Travel Time from Each Origin (minutes)")
-plt.tight_layout()
 plt.show()
-
-# === STATISTICS FOR MEAN TRAVEL TIMES ===
-print("\nMean travel time statistics (in minutes):")
-print(f"Mean: {points['mean_time_min'].mean():.2f}")
-print(f"Min:  {points['mean_time_min'].min():.2f}")
-print(f"Max:  {points['mean_time_min'].max():.2f}")
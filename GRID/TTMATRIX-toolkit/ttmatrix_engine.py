@@ -0,0 +1,1135 @@
+# ================================================================
+# MRRH2018 TTMATRIX ROUTING ENGINE
+# Part of the MRRH2018 Toolkit
+#
+# Authors: Gabriel Ahlfeldt & Tobias Seidel
+# Purpose: Shared routing helpers for the TTMATRIX-*.py scripts.
+#          Maps the augmented transit + walking graph to contiguous
+#          integer node ids (cached on disk between runs), stores it
+#          as a sparse CSR matrix and computes shortest-path travel
+#          times between all points, optionally in parallel over
+#          chunks of origins, and writes the resulting matrices as
+#          CSV, .npy, .mat or tiled .npy files (GRID/matrix_io.py),
+#          optionally streaming origin blocks to disk within a memory
+#          budget. With a travel time cutoff only pairs within reach
+#          are routed and saved, as sparse (row, col, time) triplets.
+#          Scenario runs can also save just the OD pairs that changed
+#          against a baseline.
+#          A station placement search ranks many layouts drawn from a
+#          pool of candidate stations from precomputed skims.
+#
+# Dependencies: networkx, numpy, pandas, scipy, shapely (>= 2.0), tqdm
+# ================================================================
+
+import hashlib
+import math
+import multiprocessing as mp
+import os
+import sys
+from functools import partial
+from itertools import combinations, repeat
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.io import savemat
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+from shapely.ops import split
+from tqdm import tqdm
+
+# Matrix writers and readers are shared with the GRID-toolkit (GRID/matrix_io.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matrix_io import block_rows_for_budget, open_matrix_writers, stream_matrix_blocks
+
+ROUTING_BACKENDS = ("scipy", "networkx", "skim")
+DELTA_FORMATS = ("csv", "mat")
+EDGE_FORMATS = ("shp", "fgb", "parquet")
+EDGE_KINDS = {"transit": 0, "walk": 1, "link": 2}
+GRAPH_CACHE_VERSION = 4
+
+
+# =============================
+# ROUTING GRAPH
+# =============================
+class RoutingGraph:
+    """Augmented graph with contiguous integer node ids and edge arrays.
+
+    nodes[k] is the original node label of id k and node_xy[k] its
+    projected coordinates. Each undirected edge is stored once in
+    edge_u/edge_v; routing uses directed=False. edge_kind marks transit,
+    walking and station-link edges. Transit and walking edges carry their
+    length in edge_length_m so they can be re-weighted to new speeds
+    without rebuilding the graph. Transit edges with their own speed in
+    edge_speed_kmh keep it when the network speed changes (NaN = follow
+    the network speed). edge_geometry optionally holds the original
+    polyline of contracted edges (None = straight segment); it is only
+    used for the edge export.
+    """
+
+    def __init__(self, nodes, edge_u, edge_v, edge_weight, edge_length_m, edge_kind, node_xy=None,
+                 edge_geometry=None, edge_speed_kmh=None):
+        self.nodes = list(nodes)
+        self.node_ids = {node: k for k, node in enumerate(self.nodes)}
+        self.node_xy = None if node_xy is None else np.asarray(node_xy, dtype=np.float64)
+        self.edge_u = np.asarray(edge_u, dtype=np.int64)
+        self.edge_v = np.asarray(edge_v, dtype=np.int64)
+        self.edge_weight = np.array(edge_weight, dtype=np.float64)
+        self.edge_length_m = np.asarray(edge_length_m, dtype=np.float64)
+        self.edge_kind = np.asarray(edge_kind, dtype=np.int8)
+        self.edge_geometry = None if edge_geometry is None else np.asarray(edge_geometry, dtype=object)
+        self.edge_speed_kmh = (
+            np.full(len(self.edge_u), np.nan) if edge_speed_kmh is None
+            else np.asarray(edge_speed_kmh, dtype=np.float64)
+        )
+        self.transit = self.edge_kind == EDGE_KINDS["transit"]
+        self.walking = self.edge_kind == EDGE_KINDS["walk"]
+        self._walking_legs = {}
+
+    @classmethod
+    def from_networkx(cls, G, weight="weight", length="length_m", kind="kind", geometry="geometry"):
+        """Convert G; tuple nodes are coordinates, other nodes need a geometry attribute."""
+        nodes = list(G.nodes)
+        node_ids = {node: k for k, node in enumerate(nodes)}
+        node_xy = np.array([
+            node if isinstance(node, tuple) else (data[geometry].x, data[geometry].y)
+            for node, data in G.nodes(data=True)
+        ], dtype=np.float64).reshape(-1, 2)
+
+        n_edges = G.number_of_edges()
+        edge_u = np.empty(n_edges, dtype=np.int64)
+        edge_v = np.empty(n_edges, dtype=np.int64)
+        edge_weight = np.empty(n_edges, dtype=np.float64)
+        edge_length_m = np.full(n_edges, np.nan)
+        edge_kind = np.empty(n_edges, dtype=np.int8)
+        for k, (u, v, data) in enumerate(G.edges(data=True)):
+            edge_u[k] = node_ids[u]
+            edge_v[k] = node_ids[v]
+            edge_weight[k] = data[weight]
+            edge_length_m[k] = data.get(length, np.nan)
+            edge_kind[k] = EDGE_KINDS[data.get(kind, "link")]
+        return cls(nodes, edge_u, edge_v, edge_weight, edge_length_m, edge_kind, node_xy=node_xy)
+
+    @classmethod
+    def from_segments(cls, node_xy, seg_u, seg_v, length_m, speed_kmh, default_speed_kmh):
+        """Transit-only graph from network_segments output; nodes are labelled by coordinate tuples."""
+        graph = cls(
+            list(map(tuple, np.asarray(node_xy).tolist())), seg_u, seg_v, np.empty(len(seg_u)), length_m,
+            np.full(len(seg_u), EDGE_KINDS["transit"], dtype=np.int8), node_xy=node_xy, edge_speed_kmh=speed_kmh,
+        )
+        graph.set_network_speed(default_speed_kmh)
+        return graph
+
+    def add_nodes(self, labels, xy):
+        """Append nodes in bulk; returns their integer ids."""
+        start = len(self.nodes)
+        labels = list(labels)
+        self.nodes.extend(labels)
+        self.node_ids.update((label, start + k) for k, label in enumerate(labels))
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.node_xy = xy if self.node_xy is None else np.vstack([self.node_xy, xy])
+        return np.arange(start, start + len(labels), dtype=np.int64)
+
+    def add_edges(self, u, v, weight, length_m, kind):
+        """Append undirected edges in bulk from integer node id arrays."""
+        n_new = len(u)
+        self.edge_u = np.concatenate([self.edge_u, np.asarray(u, dtype=np.int64)])
+        self.edge_v = np.concatenate([self.edge_v, np.asarray(v, dtype=np.int64)])
+        self.edge_weight = np.concatenate([self.edge_weight, np.asarray(weight, dtype=np.float64)])
+        self.edge_length_m = np.concatenate([self.edge_length_m, np.broadcast_to(length_m, n_new)])
+        self.edge_kind = np.concatenate([self.edge_kind, np.full(n_new, EDGE_KINDS[kind], dtype=np.int8)])
+        self.edge_speed_kmh = np.concatenate([self.edge_speed_kmh, np.full(n_new, np.nan)])
+        if self.edge_geometry is not None:
+            self.edge_geometry = np.concatenate([self.edge_geometry, np.full(n_new, None, dtype=object)])
+        self.transit = self.edge_kind == EDGE_KINDS["transit"]
+        self.walking = self.edge_kind == EDGE_KINDS["walk"]
+        self._walking_legs.clear()
+
+    def contract_transit_chains(self, keep=()):
+        """Collapse chains of degree-2 transit nodes into single edges; returns a new graph.
+
+        A node is removed if it has exactly two edges, both transit with the
+        same speed setting, and is not listed in keep. Junctions, stations
+        and the network nodes that stations attach to therefore stay. Chain
+        lengths and weights are summed; parallel edges keep the shortest one
+        and loops are dropped.
+        Shortest paths between the remaining nodes are unchanged up to
+        floating-point rounding. The chain polylines go to edge_geometry.
+        """
+        n, n_edges = len(self.nodes), len(self.edge_u)
+        loop = self.edge_u == self.edge_v
+        degree = np.bincount(self.edge_u[~loop], minlength=n) + np.bincount(self.edge_v[~loop], minlength=n)
+        other = ~self.transit & ~loop
+        other_degree = np.bincount(self.edge_u[other], minlength=n) + np.bincount(self.edge_v[other], minlength=n)
+        speed_key = np.where(np.isnan(self.edge_speed_kmh), -1.0, self.edge_speed_kmh)[~loop]
+        lowest, highest = np.full(n, np.inf), np.full(n, -np.inf)
+        for ends in (self.edge_u[~loop], self.edge_v[~loop]):
+            np.minimum.at(lowest, ends, speed_key)
+            np.maximum.at(highest, ends, speed_key)
+        removable = (degree == 2) & (other_degree == 0) & (lowest == highest)
+        removable[[self.node_ids[node] for node in keep]] = False
+
+        # Edges that meet at a removable node belong to the same chain
+        edge_idx = np.flatnonzero(~loop)
+        inc_node = np.concatenate([self.edge_u[edge_idx], self.edge_v[edge_idx]])
+        inc_edge = np.concatenate([edge_idx, edge_idx])
+        at_removable = removable[inc_node]
+        order = np.argsort(inc_node[at_removable], kind="stable")
+        pairs = inc_edge[at_removable][order].reshape(-1, 2)
+        glue = csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_edges, n_edges))
+        _, chain = connected_components(glue, directed=False)
+
+        # Each chain runs between the two kept nodes at its ends; pure rings have none
+        kept_inc = ~at_removable
+        ends_chain, ends_node = chain[inc_edge[kept_inc]], inc_node[kept_inc]
+        order = np.argsort(ends_chain, kind="stable")
+        ends_chain, ends_node = ends_chain[order], ends_node[order]
+        n_chains = chain.max() + 1 if n_edges else 0
+        n_ends = np.bincount(ends_chain, minlength=n_chains)
+        first = np.concatenate(([0], np.cumsum(n_ends)[:-1]))
+        valid = np.flatnonzero(n_ends == 2)
+        new_u, new_v = ends_node[first[valid]], ends_node[first[valid] + 1]
+
+        used = ~loop
+        weight = np.bincount(chain[used], weights=self.edge_weight[used], minlength=n_chains)[valid]
+        length = np.bincount(chain[used], weights=self.edge_length_m[used], minlength=n_chains)[valid]
+        kind = np.zeros(n_chains, dtype=np.int8)
+        kind[chain[used]] = self.edge_kind[used]
+        kind = kind[valid]
+        speed = np.full(n_chains, np.nan)
+        speed[chain[used]] = self.edge_speed_kmh[used]
+        speed = speed[valid]
+
+        # Chain polylines (export only): merge the original segments of each chain
+        geometry = np.full(len(valid), None, dtype=object)
+        if self.node_xy is not None:
+            by_chain = np.argsort(chain[used], kind="stable")
+            segments = shapely.linestrings(np.stack(
+                [self.node_xy[self.edge_u[used][by_chain]], self.node_xy[self.edge_v[used][by_chain]]], axis=1
+            ))
+            merged = shapely.line_merge(shapely.multilinestrings(segments, indices=chain[used][by_chain]))
+            chain_size = np.bincount(chain[used], minlength=n_chains)[valid]
+            geometry[chain_size > 1] = merged[valid][chain_size > 1]
+
+        keep_edge = (new_u != new_v)
+        lo, hi = np.minimum(new_u, new_v), np.maximum(new_u, new_v)
+        order = np.lexsort((weight, hi, lo))
+        order = order[keep_edge[order]]
+        first_of_pair = np.ones(len(order), dtype=bool)
+        first_of_pair[1:] = (lo[order][1:] != lo[order][:-1]) | (hi[order][1:] != hi[order][:-1])
+        selected = np.sort(order[first_of_pair])
+
+        new_id = np.cumsum(~removable) - 1
+        kept_nodes = np.flatnonzero(~removable)
+        return RoutingGraph(
+            [self.nodes[k] for k in kept_nodes], new_id[new_u[selected]], new_id[new_v[selected]], weight[selected],
+            length[selected], kind[selected], node_xy=None if self.node_xy is None else self.node_xy[kept_nodes],
+            edge_geometry=geometry[selected], edge_speed_kmh=speed[selected],
+        )
+
+    def set_network_speed(self, speed_kmh):
+        """Re-weight transit edges to travel times (minutes) at speed_kmh or their own speed."""
+        speed = np.where(np.isnan(self.edge_speed_kmh), speed_kmh, self.edge_speed_kmh)
+        self.edge_weight[self.transit] = (self.edge_length_m[self.transit] / 1000) / speed[self.transit] * 60
+
+    def set_walking_speed(self, speed_kmh):
+        """Re-weight walking edges to travel times (minutes) at speed_kmh."""
+        self.edge_weight[self.walking] = (self.edge_length_m[self.walking] / 1000) / speed_kmh * 60
+        self._walking_legs.clear()
+
+    def edges(self):
+        """Iterate over (u_label, v_label, weight) in storage order."""
+        for u, v, w in zip(self.edge_u, self.edge_v, self.edge_weight):
+            yield self.nodes[u], self.nodes[v], w
+
+    def to_csr(self, edge_mask=None):
+        """Sparse adjacency matrix; zero-weight edges stay explicit entries."""
+        n = len(self.nodes)
+        if edge_mask is None:
+            return csr_matrix((self.edge_weight, (self.edge_u, self.edge_v)), shape=(n, n))
+        return csr_matrix(
+            (self.edge_weight[edge_mask], (self.edge_u[edge_mask], self.edge_v[edge_mask])), shape=(n, n)
+        )
+
+    def to_networkx(self, weight="weight"):
+        G = nx.Graph()
+        G.add_nodes_from(self.nodes)
+        G.add_weighted_edges_from(self.edges(), weight=weight)
+        return G
+
+    def walking_csr(self, point_ids, station_ids):
+        """Adjacency matrix of the walking graph: points, stations and the edges between them."""
+        on_foot = np.zeros(len(self.nodes), dtype=bool)
+        on_foot[point_ids] = True
+        on_foot[station_ids] = True
+        return self.to_csr(on_foot[self.edge_u] & on_foot[self.edge_v])
+
+    def access_times(self, point_ids, station_ids):
+        """Point-to-station walking times (n x k), cached like walking_legs."""
+        key = ("access", tuple(point_ids), tuple(station_ids))
+        if key not in self._walking_legs:
+            walking_csr = self.walking_csr(point_ids, station_ids)
+            access = dijkstra(walking_csr, directed=False, indices=station_ids)[:, point_ids].T
+            self._walking_legs[key] = np.ascontiguousarray(access)
+        return self._walking_legs[key]
+
+    def walking_legs(self, point_ids, station_ids, n_workers=1):
+        """Walking-only point-to-point times and point-to-station access times.
+
+        The walking graph contains the points, the stations and all edges
+        between them. Results do not depend on the network speed and are
+        cached, so they are computed once for all scenarios. The walking
+        matrix is a dense n x n array; tiled and cutoff runs route walking
+        rows per block instead (see _skim_solver).
+        """
+        key = (tuple(point_ids), tuple(station_ids))
+        if key not in self._walking_legs:
+            walking_csr = self.walking_csr(point_ids, station_ids)
+
+            n = len(point_ids)
+            print("Computing walking-only travel times (computed once for all scenarios)...")
+            walk = _fill_matrix(partial(_scipy_rows, walking_csr, point_ids), n,
+                                _default_chunk_size(n, n_workers), n_workers)
+            walk[np.isnan(walk)] = np.inf
+            self._walking_legs[key] = (walk, self.access_times(point_ids, station_ids))
+        return self._walking_legs[key]
+
+    def edge_frame(self, kinds=None):
+        """Edges as a DataFrame with from_node, to_node, time_min, kind and geometry.
+
+        Geometries are straight segments between node_xy, built in one
+        shapely.linestrings call. kinds limits the frame to some edge kinds,
+        e.g. ("transit",).
+        """
+        if kinds is None:
+            mask = np.ones(len(self.edge_u), dtype=bool)
+        else:
+            mask = np.isin(self.edge_kind, [EDGE_KINDS[kind] for kind in kinds])
+        u, v = self.edge_u[mask], self.edge_v[mask]
+        labels = pd.Series(self.nodes, dtype=object).astype(str).to_numpy()
+        kind_names = np.array(list(EDGE_KINDS), dtype=object)[np.argsort(list(EDGE_KINDS.values()))]
+        geometry = shapely.linestrings(np.stack([self.node_xy[u], self.node_xy[v]], axis=1))
+        if self.edge_geometry is not None:
+            original = self.edge_geometry[mask]
+            geometry = np.where(pd.isna(original), geometry, original)
+        return pd.DataFrame({
+            "from_node": labels[u],
+            "to_node": labels[v],
+            "time_min": self.edge_weight[mask],
+            "kind": kind_names[self.edge_kind[mask]],
+            "geometry": geometry,
+        })
+
+
+# =============================
+# NETWORK PREPARATION
+# =============================
+def snap_line_endpoints(lines, tolerance_m):
+    """Move line endpoints that lie within tolerance_m of each other onto one point.
+
+    All close endpoint pairs come from one KD-tree query_pairs call; the
+    connected components of those pairs are the clusters, so the result
+    does not depend on the order of the lines. Each endpoint in a cluster
+    is replaced by the cluster centroid; interior vertices are left alone.
+    """
+    lines = np.array(lines, dtype=object)
+    n_coords = shapely.get_num_coordinates(lines)
+    include_z = bool(shapely.has_z(lines).any())
+    coords = shapely.get_coordinates(lines, include_z=include_z)
+    offsets = np.concatenate(([0], np.cumsum(n_coords)))
+    has_ends = n_coords >= 2
+    endpoint_rows = np.concatenate((offsets[:-1][has_ends], offsets[1:][has_ends] - 1))
+    if len(endpoint_rows) < 2:
+        return lines
+
+    endpoint_xy = coords[endpoint_rows, :2]
+    pairs = cKDTree(endpoint_xy).query_pairs(r=tolerance_m, output_type="ndarray")
+    n = len(endpoint_xy)
+    adjacency = csr_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(adjacency, directed=False)
+
+    counts = np.bincount(labels)
+    clustered = counts[labels] > 1
+    for axis in range(2):
+        centroids = np.bincount(labels, weights=endpoint_xy[:, axis]) / counts
+        coords[endpoint_rows[clustered], axis] = centroids[labels[clustered]]
+    return shapely.set_coordinates(lines, coords)
+
+
+def split_lines_at_points(lines, points, buffer_m=0.5, return_index=False):
+    """Split lines where they pass through a buffer around any of the points.
+
+    Line/buffer pairs come from one bulk STRtree query, so only lines that
+    actually touch a buffer are split. Segments keep the order of the
+    input lines and of the pieces returned by shapely's split. With
+    return_index, also returns the input line index of every segment.
+    """
+    lines = np.asarray(lines, dtype=object)
+    buffers = shapely.buffer(np.asarray(points, dtype=object), buffer_m, quad_segs=16)
+    line_idx, buffer_idx = shapely.STRtree(buffers).query(lines, predicate="intersects")
+    order = np.lexsort((buffer_idx, line_idx))
+    line_idx, buffer_idx = line_idx[order], buffer_idx[order]
+    hit_lines, starts = np.unique(line_idx, return_index=True)
+    hits = dict(zip(hit_lines.tolist(), np.split(buffer_idx, starts[1:])))
+
+    new_geoms, source = [], []
+    for i, line in enumerate(lines):
+        if i not in hits:
+            new_geoms.append(line)
+            source.append(i)
+            continue
+        try:
+            result = split(line, shapely.union_all(buffers[hits[i]]))
+            pieces = [segment for segment in result.geoms if segment.length > 0]
+        except Exception as e:
+            print(f"Warning: could not split line: {e}")
+            pieces = [line]
+        new_geoms.extend(pieces)
+        source.extend([i] * len(pieces))
+    if return_index:
+        return new_geoms, np.array(source, dtype=np.int64)
+    return new_geoms
+
+
+def network_segments(lines, precision_m=0.001, speeds=None):
+    """Explode lines into straight segments between deduplicated vertices.
+
+    Works on whole arrays: vertices whose coordinates round to the same
+    multiple of precision_m become one node, placed at the first such
+    vertex. Segment lengths are taken from the original vertices.
+    speeds gives one value per line (NaN = none). Zero-length segments are
+    dropped; of several segments joining the same two nodes the last one is
+    kept, as when they were added to a networkx graph one by one.
+    Returns (node_xy, seg_u, seg_v, length_m, speed_kmh).
+    """
+    parts, part_line = shapely.get_parts(np.asarray(lines, dtype=object), return_index=True)
+    xy, vertex_part = shapely.get_coordinates(parts, return_index=True)
+    keys = np.round(xy / precision_m).astype(np.int64)
+    _, first, vertex_node = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    vertex_node = vertex_node.ravel()
+    # Number nodes in order of first appearance
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    vertex_node = rank[vertex_node]
+    node_xy = xy[np.sort(first)]
+
+    within = vertex_part[1:] == vertex_part[:-1]
+    a, b = np.flatnonzero(within), np.flatnonzero(within) + 1
+    seg_u, seg_v = vertex_node[a], vertex_node[b]
+    delta = xy[b] - xy[a]
+    length_m = np.sqrt(delta[:, 0] ** 2 + delta[:, 1] ** 2)
+    speed_kmh = (
+        np.full(len(a), np.nan) if speeds is None
+        else np.asarray(speeds, dtype=np.float64)[part_line[vertex_part[a]]]
+    )
+
+    lo, hi = np.minimum(seg_u, seg_v), np.maximum(seg_u, seg_v)
+    _, last_rev = np.unique(np.stack([lo, hi])[:, ::-1], axis=1, return_index=True)
+    last = np.sort(len(lo) - 1 - last_rev)
+    last = last[lo[last] != hi[last]]
+    return node_xy, seg_u[last], seg_v[last], length_m[last], speed_kmh[last]
+
+
+# =============================
+# ARTIFICIAL STATIONS
+# =============================
+def grid_hash_labels(xy, cell_size):
+    """Cluster points by the square cell of side cell_size that they fall in.
+
+    A fast alternative to DBSCAN for regular grids of points. Labels run
+    from 0 in lexicographic order of the cells.
+    """
+    cells = np.floor(np.asarray(xy, dtype=float) / cell_size).astype(np.int64)
+    _, labels = np.unique(cells, axis=0, return_inverse=True)
+    return labels.ravel()
+
+
+def cluster_centroids(xy, labels):
+    """Mean coordinate of each cluster, in label order (labels 0..k-1)."""
+    xy = np.asarray(xy, dtype=float)
+    counts = np.bincount(labels)
+    return np.column_stack([np.bincount(labels, weights=xy[:, axis]) / counts for axis in range(2)])
+
+
+def project_to_nearest_lines(xy, lines):
+    """Project each point onto its nearest line.
+
+    The nearest lines come from one bulk STRtree query; ties go to the
+    first line, as with an idxmin over distances. Returns an array of
+    shapely Points on the lines.
+    """
+    lines = np.asarray(lines, dtype=object)
+    points = shapely.points(xy)
+    point_idx, line_idx = shapely.STRtree(lines).query_nearest(points, all_matches=True)
+    order = np.lexsort((line_idx, point_idx))
+    _, first = np.unique(point_idx[order], return_index=True)
+    nearest = lines[line_idx[order][first]]
+    return shapely.line_interpolate_point(nearest, shapely.line_locate_point(nearest, points))
+
+
+# =============================
+# WALKING LINKS
+# =============================
+def nearest_links(query_xy, target_xy, k, exclude_self=False):
+    """Links from every query point to its k nearest targets, in one bulk query.
+
+    Returns (query_index, target_index, distance) arrays. With exclude_self
+    (query and target are the same set) the nearest hit, i.e. the point
+    itself, is skipped and the symmetric duplicates i-j / j-i are merged.
+    """
+    query_xy = np.asarray(query_xy, dtype=np.float64).reshape(-1, 2)
+    target_xy = np.asarray(target_xy, dtype=np.float64).reshape(-1, 2)
+    first = 2 if exclude_self else 1
+    k = min(k, len(target_xy) - first + 1)
+    if k <= 0 or len(query_xy) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+
+    distances, targets = cKDTree(target_xy).query(query_xy, k=list(range(first, first + k)))
+    sources = np.repeat(np.arange(len(query_xy), dtype=np.int64), k)
+    targets = targets.ravel().astype(np.int64)
+    distances = distances.ravel()
+
+    if exclude_self:
+        lo, hi = np.minimum(sources, targets), np.maximum(sources, targets)
+        keep = lo != hi
+        _, first_hit = np.unique(np.stack([lo[keep], hi[keep]]), axis=1, return_index=True)
+        order = np.sort(first_hit)
+        sources, targets, distances = lo[keep][order], hi[keep][order], distances[keep][order]
+    return sources, targets, distances
+
+
+# =============================
+# GRAPH CACHE
+# =============================
+def graph_cache_key(paths, settings):
+    """Content hash of the input shapefiles and the graph-affecting settings."""
+    digest = hashlib.sha256(f"v{GRAPH_CACHE_VERSION}|{sorted(settings.items())!r}".encode())
+    for path in paths:
+        digest.update(f"|{os.path.basename(path) if path else None}".encode())
+        if not path:
+            continue
+        stem = os.path.splitext(path)[0]
+        for ext in (".shp", ".shx", ".dbf", ".prj"):
+            if os.path.exists(stem + ext):
+                with open(stem + ext, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def save_routing_graph(path, graph, station_nodes, crs):
+    """Store the routing graph as uncompressed NumPy arrays (.npz).
+
+    Contracted-edge polylines are stored as flat vertex coordinates with the
+    edge index of each vertex, so the cache loads without pickle.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    geometry = np.full(len(graph.edge_u), None, dtype=object) if graph.edge_geometry is None else graph.edge_geometry
+    geometry_xy, geometry_edge = shapely.get_coordinates(geometry, return_index=True)
+    np.savez(
+        path,
+        nodes=np.array([str(node) for node in graph.nodes]),
+        node_xy=graph.node_xy,
+        edge_u=graph.edge_u,
+        edge_v=graph.edge_v,
+        edge_weight=graph.edge_weight,
+        edge_length_m=graph.edge_length_m,
+        edge_kind=graph.edge_kind,
+        edge_speed_kmh=graph.edge_speed_kmh,
+        edge_geometry_xy=geometry_xy,
+        edge_geometry_edge=geometry_edge,
+        station_nodes=np.array([str(node) for node in station_nodes]),
+        crs=np.array(crs.to_wkt()),
+    )
+
+
+def load_routing_graph(path):
+    """Return (graph, station_nodes, crs_wkt) from a cache file, or None if absent.
+
+    Network node labels are restored as strings of their coordinate tuples.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        geometry = np.full(len(data["edge_u"]), None, dtype=object)
+        edges, vertex_edge = np.unique(data["edge_geometry_edge"], return_inverse=True)
+        geometry[edges] = shapely.linestrings(data["edge_geometry_xy"], indices=vertex_edge)
+        graph = RoutingGraph(
+            data["nodes"].tolist(), data["edge_u"], data["edge_v"], data["edge_weight"],
+            data["edge_length_m"], data["edge_kind"], node_xy=data["node_xy"], edge_geometry=geometry,
+            edge_speed_kmh=data["edge_speed_kmh"],
+        )
+        return graph, data["station_nodes"].tolist(), str(data["crs"])
+
+
+# =============================
+# ROW SOLVERS
+# =============================
+def _networkx_rows(G, point_nodes, start, stop, weight="weight", cutoff=None):
+    """Travel times from point_nodes[start:stop] to all point nodes (networkx)."""
+    n = len(point_nodes)
+    rows = np.empty((stop - start, n))
+    for r, source in enumerate(point_nodes[start:stop]):
+        lengths = nx.single_source_dijkstra_path_length(G, source, cutoff=cutoff, weight=weight)
+        rows[r] = np.fromiter(map(lengths.get, point_nodes, repeat(np.nan, n)), dtype=np.float64, count=n)
+    return rows
+
+
+def _scipy_rows(csr, point_ids, start, stop, limit=np.inf):
+    """Travel times from point_ids[start:stop] to all point ids (compiled)."""
+    dist = dijkstra(csr, directed=False, indices=point_ids[start:stop], limit=limit)
+    rows = dist[:, point_ids]
+    rows[np.isinf(rows)] = np.nan
+    return rows
+
+
+def _walking_rows(csr, point_ids, start, stop, limit=np.inf):
+    """Walking-only times from point_ids[start:stop] to all point ids, inf if out of reach."""
+    return dijkstra(csr, directed=False, indices=point_ids[start:stop], limit=limit)[:, point_ids]
+
+
+def _cached_rows(matrix, start, stop, limit=np.inf):
+    return matrix[start:stop]
+
+
+def _skim_rows(walk_rows, access, skim, start, stop, block_cells=4_000_000, limit=np.inf):
+    """Travel times from points start:stop composed from walking legs and the station skim.
+
+    walk_rows(start, stop, limit) returns the walking-only rows, either
+    sliced from the cached matrix or routed on demand.
+    """
+    n, k = access.shape
+    access_t = access.T
+    rows = np.empty((stop - start, n))
+    step = max(1, block_cells // max(n * k, 1))
+    for s in range(start, stop, step):
+        e = min(s + step, stop)
+        # Best time from each origin to each alighting station t via transit
+        to_station = np.min(access[s:e, :, None] + skim[None, :, :], axis=1)
+        via_transit = np.min(to_station[:, :, None] + access_t[None, :, :], axis=1)
+        rows[s - start:e - start] = np.minimum(walk_rows(s, e, limit=limit), via_transit)
+    rows[rows > limit] = np.inf
+    rows[np.isinf(rows)] = np.nan
+    return rows
+
+
+# =============================
+# SERIAL / PARALLEL DRIVER
+# =============================
+# State inherited by forked workers: the graph is shared read-only through
+# copy-on-write and every worker writes its rows into the same shared buffers.
+_PARALLEL_STATE = {}
+
+
+def _solve_chunk(task):
+    start, stop, buffer, offset = task
+    _PARALLEL_STATE["buffers"][buffer][offset:offset + stop - start] = _PARALLEL_STATE["solve_rows"](start, stop)
+    return stop - start
+
+
+def _iter_row_blocks(solve_rows, n, block_rows, chunk_size, n_workers, dtype=np.float64, desc="Dijkstra"):
+    """Yield (start, block) for consecutive blocks of block_rows origin rows.
+
+    Each block is filled chunk by chunk, serially or by a pool of forked
+    workers. Blocks live in two alternating buffers (one if a single block
+    covers all rows), so a yielded block stays valid until the next-but-one
+    block is requested.
+    """
+    if n_workers > 1 and "fork" not in mp.get_all_start_methods():
+        print("Parallel mode requires the 'fork' start method; falling back to serial computation.")
+        n_workers = 1
+
+    block_rows = max(1, min(block_rows, n))
+    n_buffers = 1 if block_rows == n else 2
+    if n_workers <= 1:
+        buffers = [np.empty((block_rows, n), dtype=dtype) for _ in range(n_buffers)]
+    else:
+        buffers = [
+            np.frombuffer(mp.RawArray(np.dtype(dtype).char, block_rows * n), dtype=dtype).reshape(block_rows, n)
+            for _ in range(n_buffers)
+        ]
+        _PARALLEL_STATE.update(solve_rows=solve_rows, buffers=buffers)
+
+    pool = mp.get_context("fork").Pool(n_workers) if n_workers > 1 else None
+    try:
+        with tqdm(total=n, desc=desc) as progress:
+            for k, start in enumerate(range(0, n, block_rows)):
+                stop = min(start + block_rows, n)
+                buffer = k % n_buffers
+                chunks = [(s, min(s + chunk_size, stop), buffer, s - start) for s in range(start, stop, chunk_size)]
+                if pool is None:
+                    for s, e, _, offset in chunks:
+                        buffers[buffer][offset:offset + e - s] = solve_rows(s, e)
+                        progress.update(e - s)
+                else:
+                    for done in pool.imap_unordered(_solve_chunk, chunks):
+                        progress.update(done)
+                yield start, buffers[buffer][:stop - start]
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _PARALLEL_STATE.clear()
+
+
+def _fill_matrix(solve_rows, n, chunk_size, n_workers, dtype=np.float64, desc="Dijkstra"):
+    """Evaluate solve_rows over origin chunks into a preallocated n x n array."""
+    if n == 0:
+        return np.empty((0, 0), dtype=dtype)
+    (_, matrix), = _iter_row_blocks(solve_rows, n, n, chunk_size, n_workers, dtype=dtype, desc=desc)
+    return matrix
+
+
+# =============================
+# TRAVEL TIME MATRIX
+# =============================
+def _default_chunk_size(n, n_workers):
+    return max(1, min(256, -(-n // (4 * max(n_workers, 1)))))
+
+
+def _row_solver(graph, point_nodes, backend, n_workers=1, station_nodes=None, max_time=None, bounded=False):
+    """solve_rows(start, stop) for the chosen backend, bound to graph and point_nodes.
+
+    With max_time, searches stop at that travel time and pairs beyond it
+    are NaN like unreachable pairs. bounded keeps memory within the row
+    blocks: the skim backend then routes walking rows per block instead of
+    caching the dense n x n walking matrix.
+    """
+    if backend == "networkx":
+        return partial(_networkx_rows, graph.to_networkx(), list(point_nodes), cutoff=max_time)
+    if backend == "scipy":
+        point_ids = np.array([graph.node_ids[node] for node in point_nodes], dtype=np.int64)
+        return partial(_scipy_rows, graph.to_csr(), point_ids, limit=np.inf if max_time is None else max_time)
+    if backend == "skim":
+        if station_nodes is None:
+            raise ValueError("The 'skim' backend requires station_nodes.")
+        solve_rows = _skim_solver(graph, point_nodes, station_nodes, n_workers=n_workers, walk_on_demand=bounded)
+        return solve_rows if max_time is None else partial(solve_rows, limit=max_time)
+    raise ValueError(f"Unknown routing backend '{backend}'. Choose one of {ROUTING_BACKENDS}.")
+
+
+def compute_travel_time_matrix(graph, point_nodes, backend="scipy", n_workers=1,
+                               chunk_size=None, dtype=np.float64, station_nodes=None):
+    """Shortest-path travel times between all point nodes of a RoutingGraph.
+
+    Returns a numeric (n x n) array of the requested dtype; row i and
+    column j follow the order of point_nodes, unreachable pairs are NaN.
+    With n_workers > 1 the origins are split into chunks that are routed
+    by a pool of forked processes. Each origin row is computed exactly as
+    in the serial run, so results are bit-identical.
+    The "skim" backend requires station_nodes (see travel_time_matrix_skim).
+    """
+    if isinstance(graph, nx.Graph):
+        graph = RoutingGraph.from_networkx(graph)
+    n = len(point_nodes)
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(n, n_workers)
+    solve_rows = _row_solver(graph, point_nodes, backend, n_workers=n_workers, station_nodes=station_nodes)
+    return _fill_matrix(solve_rows, n, chunk_size, n_workers, dtype=dtype)
+
+
+def iter_travel_time_blocks(graph, point_nodes, block_rows, backend="scipy", n_workers=1,
+                            chunk_size=None, dtype=np.float64, station_nodes=None):
+    """Yield (start, block) origin blocks of the travel time matrix.
+
+    Same rows as compute_travel_time_matrix, but only two blocks of
+    block_rows x n are held in memory. A block is overwritten once the
+    next-but-one block is requested, so copy it if it must be kept.
+    """
+    if isinstance(graph, nx.Graph):
+        graph = RoutingGraph.from_networkx(graph)
+    n = len(point_nodes)
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(min(block_rows, n), n_workers)
+    solve_rows = _row_solver(graph, point_nodes, backend, n_workers=n_workers, station_nodes=station_nodes,
+                             bounded=True)
+    yield from _iter_row_blocks(solve_rows, n, block_rows, chunk_size, n_workers, dtype=dtype)
+
+
+def stream_travel_time_matrix(graph, point_nodes, ids, base_path, formats, id_field, memory_budget_bytes,
+                              backend="scipy", n_workers=1, dtype=np.float64, station_nodes=None,
+                              row_labels=None, col_labels=None, on_block=None):
+    """Tiled mode: compute origin blocks and stream them to disk; returns the written paths.
+
+    Block height follows from memory_budget_bytes (two blocks in memory:
+    one being computed, one being written on a background thread). The
+    graph itself and, for the skim backend, the n x k station access times
+    and the k x k skim come on top; walking rows are routed per block.
+    on_block(start, block) is called for every block before it is written.
+    """
+    n = len(point_nodes)
+    block_rows = block_rows_for_budget(n, dtype, memory_budget_bytes)
+    print(f"Tiled mode: {block_rows} origin rows per block ({-(-n // block_rows)} blocks)")
+    writers = open_matrix_writers(base_path, formats, (n, n), dtype, ids, id_field,
+                                  row_labels=row_labels, col_labels=col_labels)
+    blocks = iter_travel_time_blocks(graph, point_nodes, block_rows, backend=backend, n_workers=n_workers,
+                                     dtype=dtype, station_nodes=station_nodes)
+    return stream_matrix_blocks(blocks, writers, on_block=on_block)
+
+
+def compute_sparse_travel_times(graph, point_nodes, max_time, backend="scipy", n_workers=1,
+                                chunk_size=None, dtype=np.float64, station_nodes=None):
+    """Travel times up to max_time (minutes) as an n x n CSR matrix.
+
+    Every search stops at the cutoff, so runtime and size grow with the
+    number of points within reach rather than with n^2. Only pairs within
+    the cutoff are stored, including exact zeros such as the diagonal;
+    pairs beyond it or unreachable are absent. Origins are routed in
+    blocks, so the dense n x n matrix never exists.
+    """
+    if isinstance(graph, nx.Graph):
+        graph = RoutingGraph.from_networkx(graph)
+    n = len(point_nodes)
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(n, n_workers)
+    solve_rows = _row_solver(graph, point_nodes, backend, n_workers=n_workers, station_nodes=station_nodes,
+                             max_time=max_time, bounded=True)
+
+    counts, indices, data = [], [], []
+    for _, block in _iter_row_blocks(solve_rows, n, chunk_size * max(n_workers, 1), chunk_size, n_workers,
+                                     dtype=dtype):
+        within = block <= max_time
+        counts.append(within.sum(axis=1))
+        indices.append(np.nonzero(within)[1])
+        data.append(block[within])
+    indptr = np.concatenate(([0], np.cumsum(np.concatenate(counts))))
+    return csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(n, n))
+
+
+# =============================
+# STATION-SKIM DECOMPOSITION
+# =============================
+def _skim_solver(graph, point_nodes, station_nodes, n_workers=1, block_cells=4_000_000, walk_on_demand=False):
+    """solve_rows for the skim backend.
+
+    By default the dense walking matrix is computed once and cached for all
+    scenarios. With walk_on_demand the walking rows of each block are routed
+    on the walking graph instead, so memory stays within the row blocks.
+    """
+    point_ids = np.array([graph.node_ids[node] for node in point_nodes], dtype=np.int64)
+    station_ids = np.array([graph.node_ids[node] for node in station_nodes], dtype=np.int64)
+    if walk_on_demand:
+        access = graph.access_times(point_ids, station_ids)
+        walk_rows = partial(_walking_rows, graph.walking_csr(point_ids, station_ids), point_ids)
+    else:
+        walk, access = graph.walking_legs(point_ids, station_ids, n_workers=n_workers)
+        walk_rows = partial(_cached_rows, walk)
+
+    print(f"Computing {len(station_ids)} x {len(station_ids)} station skim...")
+    skim = dijkstra(graph.to_csr(), directed=False, indices=station_ids)[:, station_ids]
+    return partial(_skim_rows, walk_rows, access, skim, block_cells=block_cells)
+
+
+def travel_time_matrix_skim(graph, point_nodes, station_nodes, n_workers=1, dtype=np.float64,
+                            block_cells=4_000_000):
+    """Travel times composed from walking legs and a station-to-station skim.
+
+    Points reach the transit network only through station nodes, so every
+    shortest path is either walking-only or walk + station-to-station + walk:
+
+        T[p, q] = min(W[p, q], min_{s, t} A[p, s] + S[s, t] + A[q, t])
+
+    W (walking-only point matrix) and A (point-to-station walking times)
+    are cached on the graph; each scenario only needs the K x K skim S
+    (K Dijkstras over the full graph) and a blocked min-plus reduction.
+    Results match the full Dijkstra up to floating-point rounding.
+    """
+    solve_rows = _skim_solver(graph, point_nodes, station_nodes, n_workers=n_workers, block_cells=block_cells)
+    n = len(point_nodes)
+    return _fill_matrix(solve_rows, n, _default_chunk_size(n, n_workers), n_workers, dtype=dtype, desc="Min-plus")
+
+
+# =============================
+# STATION PLACEMENT
+# =============================
+def candidate_layouts(n_candidates, size, max_layouts, seed=0):
+    """Station layouts to evaluate, as sorted tuples of candidate indices.
+
+    All combinations of size candidates if there are at most max_layouts
+    of them, otherwise max_layouts distinct random ones.
+    """
+    if math.comb(n_candidates, size) <= max_layouts:
+        return list(combinations(range(n_candidates), size))
+    rng = np.random.default_rng(seed)
+    layouts = set()
+    while len(layouts) < max_layouts:
+        layouts.add(tuple(sorted(rng.choice(n_candidates, size, replace=False).tolist())))
+    return sorted(layouts)
+
+
+def _placement_rows(walk, access, skim, start, stop):
+    """Rows start:stop of min(W, A K A') for a small station skim K (unreachable = inf)."""
+    to_station = np.min(access[start:stop, :, None] + skim[None, :, :], axis=1)
+    rows = walk[start:stop].copy()
+    via = np.empty_like(rows)
+    # One pass per alighting station is much faster than a 3-D min for a few stations
+    access_t = np.ascontiguousarray(access.T)
+    for t in range(skim.shape[1]):
+        np.add(to_station[:, t, None], access_t[t], out=via)
+        np.minimum(rows, via, out=rows)
+    return rows
+
+
+class StationPlacement:
+    """Scores station layouts drawn from a pool of candidate stations.
+
+    The graph holds all candidates and a layout opens a subset S of them:
+    points walk on the shared walking graph (points and all candidates)
+    and board the network only at stations in S. With W the walking-only
+    point matrix, A the point-to-candidate walking times and D the
+    candidate-to-candidate min(network, walking) times, a layout's travel
+    times are
+
+        T = min(W, A_S K_S A_S')   (min-plus products)
+
+    where K_S is the shortest-path closure of D over S. W, A and D are
+    computed once, so each layout only costs a |S| x |S| closure and a
+    min-plus reduction. Layouts are scored by the mean of T over all OD
+    pairs, weighted by weights[p] * weights[q] (e.g. population).
+    """
+
+    def __init__(self, graph, point_nodes, candidate_nodes, weights=None, n_workers=1, block_cells=4_000_000):
+        point_ids = np.array([graph.node_ids[node] for node in point_nodes], dtype=np.int64)
+        candidate_ids = np.array([graph.node_ids[node] for node in candidate_nodes], dtype=np.int64)
+        self.walk, self.access = graph.walking_legs(point_ids, candidate_ids, n_workers=n_workers)
+
+        print(f"Computing {len(candidate_ids)} x {len(candidate_ids)} candidate skims...")
+        on_network = dijkstra(graph.to_csr(~graph.walking), directed=False, indices=candidate_ids)[:, candidate_ids]
+        on_foot = dijkstra(graph.walking_csr(point_ids, candidate_ids), directed=False,
+                           indices=candidate_ids)[:, candidate_ids]
+        self.links = np.minimum(on_network, on_foot)
+        self.weights = np.ones(len(point_ids)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.block_cells = block_cells
+        self.walk_only = self._weighted_mean(lambda s, e: self.walk[s:e])
+
+    def _layout_rows(self, layout):
+        layout = np.asarray(layout, dtype=np.int64)
+        skim = self.links[np.ix_(layout, layout)]
+        for m in range(len(layout)):
+            skim = np.minimum(skim, skim[:, m, None] + skim[None, m, :])
+        return partial(_placement_rows, self.walk, self.access[:, layout], skim)
+
+    def _weighted_mean(self, solve_rows):
+        n = len(self.weights)
+        total = weight = 0.0
+        step = max(1, self.block_cells // max(n, 1))
+        for s in range(0, n, step):
+            e = min(s + step, n)
+            times = solve_rows(s, e)
+            reachable = np.isfinite(times)
+            total += self.weights[s:e] @ np.where(reachable, times, 0.0) @ self.weights
+            weight += self.weights[s:e] @ reachable @ self.weights
+        return total / weight if weight > 0 else np.nan
+
+    def travel_times(self, layout):
+        """Full n x n travel time matrix of a layout (NaN = unreachable)."""
+        times = self._layout_rows(layout)(0, len(self.weights))
+        times[np.isinf(times)] = np.nan
+        return times
+
+    def score(self, layout):
+        """Weighted mean travel time (minutes) of a layout."""
+        return self._weighted_mean(self._layout_rows(layout))
+
+    def rank(self, layouts):
+        """DataFrame of layouts ranked by weighted mean time, best first.
+
+        time_saved_min is the gain over walking only (no open station).
+        """
+        layouts = [tuple(layout) for layout in layouts]
+        scores = np.fromiter((self.score(layout) for layout in tqdm(layouts, desc="Layouts")), dtype=np.float64,
+                             count=len(layouts))
+        order = np.argsort(scores, kind="stable")
+        return pd.DataFrame({
+            "rank": np.arange(1, len(layouts) + 1),
+            "layout": [layouts[k] for k in order],
+            "wmean_time_min": scores[order],
+            "time_saved_min": self.walk_only - scores[order],
+        })
+
+
+# =============================
+# ACCESSIBILITY
+# =============================
+class AccessibilityReducer:
+    """Per-origin accessibility measures, folded in one block of rows at a time.
+
+    For origin i with travel times t_ij (NaN = unreachable) the results are
+      mean_time_min    mean of t_ij over reachable destinations
+      <field>_wtime    mean of t_ij weighted by weights[field], e.g. pop_wtime
+      emp_<T>min       sum of weights[jobs_field] over destinations with t_ij <= T
+      mkt_access       sum_j weights[jobs_field] * exp(-decay * t_ij)
+    Only these per-origin sums are kept, so the full matrix never has to
+    exist: set them from dense rows (set_rows), e.g. one row block of a
+    tiled run at a time, or from a cutoff matrix (set_sparse), where pairs
+    that are not stored count as unreachable. Each origin row is computed
+    from one call; a later call for the same rows replaces it.
+    """
+
+    def __init__(self, n, weights=None, jobs_field=None, thresholds_min=(), decay=None):
+        self.n = n
+        self.weights = {field: np.asarray(w, dtype=np.float64) for field, w in (weights or {}).items()}
+        self.jobs_field = jobs_field
+        self.thresholds_min = list(thresholds_min) if jobs_field is not None else []
+        self.decay = decay if jobs_field is not None else None
+        self._time_sum = np.zeros(n)
+        self._count = np.zeros(n)
+        self._weighted_time = {field: np.zeros(n) for field in self.weights}
+        self._weight_total = {field: np.zeros(n) for field in self.weights}
+        self._within = {threshold: np.zeros(n) for threshold in self.thresholds_min}
+        self._market_access = np.zeros(n)
+
+    def set_rows(self, start, block, block_cells=4_000_000):
+        """Set the sums of origins start:start+len(block) from these dense rows of the travel time matrix.
+
+        Blocks must be disjoint and cover all origins; rows are replaced,
+        not accumulated.
+        """
+        step = max(1, block_cells // max(self.n, 1))
+        for offset in range(0, len(block), step):
+            times = np.asarray(block[offset:offset + step], dtype=np.float64)
+            rows = slice(start + offset, start + offset + len(times))
+            reachable = ~np.isnan(times)
+            times_or_zero = np.where(reachable, times, 0.0)
+            self._time_sum[rows] = times_or_zero.sum(axis=1)
+            self._count[rows] = reachable.sum(axis=1)
+            for field, w in self.weights.items():
+                self._weighted_time[field][rows] = times_or_zero @ w
+                self._weight_total[field][rows] = reachable @ w
+            if self.jobs_field is not None:
+                jobs = self.weights[self.jobs_field]
+                for threshold in self.thresholds_min:
+                    self._within[threshold][rows] = (times <= threshold) @ jobs
+                if self.decay is not None:
+                    self._market_access[rows] = np.where(reachable, np.exp(-self.decay * times_or_zero), 0.0) @ jobs
+
+    def set_sparse(self, matrix):
+        """Set the sums of all origins from a sparse n x n matrix of travel times within a cutoff.
+
+        Pairs beyond the cutoff are not stored and count as unreachable, so
+        every measure, market access included, covers only pairs within it.
+        """
+        matrix = matrix.tocsr()
+        times = matrix.data.astype(np.float64)
+
+        def row_sums(values, w=None):
+            rows = csr_matrix((values, matrix.indices, matrix.indptr), shape=matrix.shape)
+            return np.asarray(rows.sum(axis=1)).ravel() if w is None else rows @ w
+
+        ones = np.ones_like(times)
+        self._time_sum = row_sums(times)
+        self._count = np.diff(matrix.indptr).astype(np.float64)
+        for field, w in self.weights.items():
+            self._weighted_time[field] = row_sums(times, w)
+            self._weight_total[field] = row_sums(ones, w)
+        if self.jobs_field is not None:
+            jobs = self.weights[self.jobs_field]
+            for threshold in self.thresholds_min:
+                self._within[threshold] = row_sums((times <= threshold).astype(np.float64), jobs)
+            if self.decay is not None:
+                self._market_access = row_sums(np.exp(-self.decay * times), jobs)
+
+    def results(self):
+        """DataFrame with one row per origin and one column per measure."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = {"mean_time_min": np.where(self._count > 0, self._time_sum / self._count, np.nan)}
+            for field in self.weights:
+                total = self._weight_total[field]
+                out[f"{field}_wtime"] = np.where(total > 0, self._weighted_time[field] / total, np.nan)
+        for threshold in self.thresholds_min:
+            out[f"{self.jobs_field}_{threshold:g}min"] = self._within[threshold]
+        if self.decay is not None:
+            out["mkt_access"] = self._market_access
+        return pd.DataFrame(out)
+
+
+# =============================
+# SCENARIO DELTA
+# =============================
+class ScenarioDelta:
+    """OD pairs whose travel time differs between a baseline and a scenario.
+
+    Baseline and scenario rows are folded in block by block (add, or
+    add_sparse for cutoff matrices where absent pairs are beyond reach).
+    A pair counts as changed if its time moves by more than tolerance or
+    it becomes reachable/unreachable (NaN). changed_origins marks every
+    origin with at least one changed pair.
+    """
+
+    def __init__(self, n, tolerance=1e-6):
+        self.n = n
+        self.tolerance = tolerance
+        self.changed_origins = np.zeros(n, dtype=bool)
+        self._parts = []
+
+    def _changed(self, old, new):
+        return (np.abs(new - old) > self.tolerance) | (np.isnan(old) != np.isnan(new))
+
+    def add(self, start, old, new, block_cells=4_000_000):
+        """Fold in dense rows start:start+len(new) of both matrices."""
+        step = max(1, block_cells // max(self.n, 1))
+        for offset in range(0, len(new), step):
+            old_rows = np.asarray(old[offset:offset + step], dtype=np.float64)
+            new_rows = np.asarray(new[offset:offset + step], dtype=np.float64)
+            changed = self._changed(old_rows, new_rows)
+            rows, cols = np.nonzero(changed)
+            self._parts.append((rows + start + offset, cols, old_rows[changed], new_rows[changed]))
+            self.changed_origins[start + offset:start + offset + len(new_rows)] |= changed.any(axis=1)
+
+    def add_sparse(self, old, new):
+        """Fold in two sparse n x n matrices; pairs stored in neither are unchanged."""
+        old, new = old.tocoo(), new.tocoo()
+        old_keys = old.row.astype(np.int64) * self.n + old.col
+        new_keys = new.row.astype(np.int64) * self.n + new.col
+        keys = np.union1d(old_keys, new_keys)
+        old_values = np.full(len(keys), np.nan)
+        old_values[np.searchsorted(keys, old_keys)] = old.data
+        new_values = np.full(len(keys), np.nan)
+        new_values[np.searchsorted(keys, new_keys)] = new.data
+        changed = self._changed(old_values, new_values)
+        rows, cols = keys[changed] // self.n, keys[changed] % self.n
+        self._parts.append((rows, cols, old_values[changed], new_values[changed]))
+        self.changed_origins[rows] = True
+
+    def pairs(self):
+        """Changed pairs as 0-based row/col arrays and old/new times, sorted by row and col."""
+        if not self._parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        rows, cols, old, new = (np.concatenate(part) for part in zip(*self._parts))
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order], old[order], new[order]
+
+    def save(self, base_path, ids, id_field, formats):
+        """Write <base_path>.csv/.mat (1-based row, col, old_time_min, new_time_min) and the origin mask.
+
+        The csv format adds <base_path>_origins.csv with a 0/1 'changed'
+        column per origin; the .mat file holds it as changed_origins.
+        Returns the written paths.
+        """
+        rows, cols, old, new = self.pairs()
+        written = []
+        for fmt in formats:
+            path = f"{base_path}.{fmt}"
+            if fmt == "csv":
+                pd.DataFrame({"row": rows + 1, "col": cols + 1, "old_time_min": old, "new_time_min": new}).to_csv(
+                    path, index=False)
+                origins_path = f"{base_path}_origins.csv"
+                pd.DataFrame({id_field: ids, "changed": self.changed_origins.astype(np.int8)}).to_csv(
+                    origins_path, index=False)
+                written.extend([path, origins_path])
+            elif fmt == "mat":
+                savemat(path, {
+                    "row": (rows + 1).astype(np.float64).reshape(-1, 1),
+                    "col": (cols + 1).astype(np.float64).reshape(-1, 1),
+                    "old_time_min": old.reshape(-1, 1),
+                    "new_time_min": new.reshape(-1, 1),
+                    "changed_origins": self.changed_origins.astype(np.float64).reshape(-1, 1),
+                    "n": float(self.n),
+                    id_field: np.asarray(ids).reshape(-1, 1),
+                }, do_compression=False)
+                written.append(path)
+            else:
+                raise ValueError(f"Unknown delta format '{fmt}'. Choose from {DELTA_FORMATS}.")
+        return written
@@ -0,0 +1,320 @@
+# ================================================================
+# MRRH2018 MATRIX INPUT / OUTPUT
+# Part of the MRRH2018 Toolkit
+#
+# Authors: Gabriel Ahlfeldt & Tobias Seidel
+# Purpose: Matrix writers and readers shared by the GRID-toolkit and
+#          TTMATRIX-toolkit scripts and ttmatrix_engine.py. Writes
+#          bilateral matrices as CSV, .npy, .mat or tiled .npy files,
+#          either in one piece or streamed in row blocks, and sparse
+#          matrices as (row, col, value) triplets.
+#
+# Dependencies: numpy, pandas, scipy
+# ================================================================
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+from scipy.sparse import save_npz
+
+MATRIX_FORMATS = ("csv", "npy", "mat", "tiles")
+SPARSE_MATRIX_FORMATS = ("csv", "mat", "npz")
+MAT_FILE_LIMIT_BYTES = 2**31 - 1  # MATLAB v5 .mat files cannot hold larger variables
+
+
+# =============================
+# MATRIX OUTPUT
+# =============================
+# Writers receive the matrix as consecutive row blocks (write_rows) so a
+# matrix can be streamed to disk while it is computed; save_matrix hands
+# them a complete in-memory matrix as a single block. close() finishes a
+# complete matrix; abort() only releases open files after an error.
+class CsvMatrixWriter:
+    """Wide CSV written row block by row block, without a labelled DataFrame.
+
+    Values are formatted as DataFrame.to_csv formats a float DataFrame of
+    the same dtype: shortest round-trip representation, NaN as an empty
+    field, and zeros as 0.0 (the object-dtype TTMATRIX matrix of earlier
+    versions wrote its diagonal as 0). Blocks must arrive in row order.
+    """
+
+    def __init__(self, path, row_labels, col_labels, index_label, block_cells=2_000_000):
+        self.paths = [path]
+        self.row_labels = row_labels
+        self.block_cells = block_cells
+        self._file = open(path, "w", newline="")
+        self._file.write(",".join([index_label] + [str(c) for c in col_labels]) + "\n")
+
+    def write_rows(self, start, block):
+        step = max(1, self.block_cells // max(block.shape[1], 1))
+        for offset in range(0, len(block), step):
+            rows = np.asarray(block[offset:offset + step])
+            text = np.where(np.isnan(rows), "", rows.astype(str))
+            labels = self.row_labels[start + offset:start + offset + len(rows)]
+            self._file.writelines(f"{label}," + ",".join(row) + "\n" for label, row in zip(labels, text))
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+
+class NpyMatrixWriter:
+    """Little-endian .npy matrix, memory-mapped while written, plus a <name>_ids.csv index."""
+
+    def __init__(self, path, shape, dtype, ids, id_field):
+        self._array = np.lib.format.open_memmap(path, mode="w+", dtype=np.dtype(dtype).newbyteorder("<"),
+                                                shape=shape)
+        ids_path = os.path.splitext(path)[0] + "_ids.csv"
+        pd.DataFrame({id_field: ids}).to_csv(ids_path, index=False)
+        self.paths = [path, ids_path]
+
+    def write_rows(self, start, block):
+        self._array[start:start + len(block)] = block
+
+    def close(self):
+        self._array.flush()
+        del self._array
+
+    def abort(self):
+        del self._array
+
+
+class MatMatrixWriter:
+    """MATLAB .mat file holding 'matrix' and the row/column ids.
+
+    .mat files are written in one piece, so the matrix has to arrive as a
+    single block (no tiled mode) and must stay below the 2 GB limit.
+    """
+
+    def __init__(self, path, shape, dtype, ids, id_field):
+        nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+        if nbytes > MAT_FILE_LIMIT_BYTES:
+            raise ValueError(
+                f"Matrix of {nbytes / 1e9:.1f} GB exceeds the 2 GB limit of .mat files. "
+                "Use the 'npy' or 'tiles' format or a float32 matrix instead."
+            )
+        self.paths = [path]
+        self.shape = shape
+        self.ids = ids
+        self.id_field = id_field
+
+    def write_rows(self, start, block):
+        if len(block) != self.shape[0]:
+            raise ValueError("The 'mat' format needs the complete matrix; use 'npy' or 'tiles' in tiled mode.")
+        savemat(self.paths[0], {"matrix": np.asarray(block), self.id_field: np.asarray(self.ids).reshape(-1, 1)},
+                do_compression=False)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class TiledMatrixWriter:
+    """Chunked on-disk store: a folder of .npy tiles plus matrix.json and ids.csv.
+
+    Each written row block is cut into tiles of tile_cols columns, so
+    row and column blocks can later be read without loading the whole
+    matrix (see TiledMatrix).
+    """
+
+    def __init__(self, path, shape, dtype, ids, id_field, tile_cols=4096):
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name == "matrix.json" or (name.startswith("tile_") and name.endswith(".npy")):
+                os.remove(os.path.join(path, name))
+        pd.DataFrame({id_field: ids}).to_csv(os.path.join(path, "ids.csv"), index=False)
+        self.paths = [path]
+        self.shape = shape
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.tile_cols = tile_cols
+        self.row_starts = []
+
+    def write_rows(self, start, block):
+        for col_start in range(0, self.shape[1], self.tile_cols):
+            tile = np.ascontiguousarray(block[:, col_start:col_start + self.tile_cols], dtype=self.dtype)
+            np.save(os.path.join(self.paths[0], f"tile_{start}_{col_start}.npy"), tile)
+        self.row_starts.append(int(start))
+
+    def close(self):
+        manifest = {
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "row_starts": sorted(self.row_starts),
+            "tile_cols": self.tile_cols,
+        }
+        with open(os.path.join(self.paths[0], "matrix.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+    def abort(self):
+        pass  # no matrix.json, so the incomplete folder cannot be opened as a TiledMatrix
+
+
+class TiledMatrix:
+    """Read access to a matrix written in the 'tiles' format.
+
+    m.rows(start, stop) and m.cols(start, stop) return row or column
+    blocks; m.block(row_slice, col_slice) any rectangle. Only the tiles
+    that overlap the request are read.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "matrix.json")) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.shape = tuple(manifest["shape"])
+        self.dtype = np.dtype(manifest["dtype"])
+        self.tile_cols = manifest["tile_cols"]
+        self.row_starts = np.array(manifest["row_starts"] + [self.shape[0]], dtype=np.int64)
+        self.ids = pd.read_csv(os.path.join(path, "ids.csv")).iloc[:, 0].to_numpy()
+
+    def block(self, rows=slice(None), cols=slice(None)):
+        row_start, row_stop, _ = rows.indices(self.shape[0])
+        col_start, col_stop, _ = cols.indices(self.shape[1])
+        out = np.empty((max(row_stop - row_start, 0), max(col_stop - col_start, 0)), dtype=self.dtype)
+        first_tile = np.searchsorted(self.row_starts, row_start, side="right") - 1
+        for k in range(max(first_tile, 0), len(self.row_starts) - 1):
+            tile_row0, tile_row1 = self.row_starts[k], self.row_starts[k + 1]
+            if tile_row0 >= row_stop:
+                break
+            r0, r1 = max(row_start, tile_row0), min(row_stop, tile_row1)
+            for tile_col0 in range(col_start - col_start % self.tile_cols, col_stop, self.tile_cols):
+                c0, c1 = max(col_start, tile_col0), min(col_stop, tile_col0 + self.tile_cols)
+                tile = np.load(os.path.join(self.path, f"tile_{tile_row0}_{tile_col0}.npy"), mmap_mode="r")
+                out[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    tile[r0 - tile_row0:r1 - tile_row0, c0 - tile_col0:c1 - tile_col0]
+        return out
+
+    def __getitem__(self, rows):
+        return self.block(rows=rows)
+
+    def rows(self, start, stop):
+        return self.block(rows=slice(start, stop))
+
+    def cols(self, start, stop):
+        return self.block(cols=slice(start, stop))
+
+
+def open_matrix_writers(base_path, formats, shape, dtype, ids, id_field, row_labels=None, col_labels=None):
+    """One writer per requested format; base_path is the output path without extension.
+
+    Rows and columns of every format follow the order of ids.
+    row_labels/col_labels only affect the CSV header and first column
+    (default: the ids). The 'tiles' format is written to <base_path>.tiles.
+    """
+    row_labels = list(ids) if row_labels is None else list(row_labels)
+    col_labels = row_labels if col_labels is None else list(col_labels)
+    writers = []
+    try:
+        for fmt in formats:
+            path = f"{base_path}.{fmt}"
+            if fmt == "csv":
+                writers.append(CsvMatrixWriter(path, row_labels, col_labels, index_label=id_field))
+            elif fmt == "npy":
+                writers.append(NpyMatrixWriter(path, shape, dtype, ids, id_field))
+            elif fmt == "mat":
+                writers.append(MatMatrixWriter(path, shape, dtype, ids, id_field))
+            elif fmt == "tiles":
+                writers.append(TiledMatrixWriter(path, shape, dtype, ids, id_field))
+            else:
+                raise ValueError(f"Unknown matrix format '{fmt}'. Choose from {MATRIX_FORMATS}.")
+    except BaseException:
+        _abort_writers(writers)
+        raise
+    return writers
+
+
+def _abort_writers(writers):
+    for writer in writers:
+        try:
+            writer.abort()
+        except Exception:
+            pass  # keep the original error
+
+
+def stream_matrix_blocks(blocks, writers, on_block=None):
+    """Write (start, block) row blocks to all writers; returns the written paths.
+
+    Writing happens on a background thread, overlapped with producing the
+    next block. At most one write is in flight: a block is handed over
+    only after the previous one is on disk, so producers may reuse two
+    alternating buffers. on_block(start, block), if given, runs first
+    in the calling thread (e.g. to fold rows into summaries). If anything
+    fails, all writers are aborted before the error is re-raised.
+    """
+    def write(start, block):
+        for writer in writers:
+            writer.write_rows(start, block)
+
+    pending = None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for start, block in blocks:
+                if on_block is not None:
+                    on_block(start, block)
+                if pending is not None:
+                    pending.result()
+                pending = executor.submit(write, start, block)
+            if pending is not None:
+                pending.result()
+        for writer in writers:
+            writer.close()
+    except BaseException:
+        _abort_writers(writers)
+        raise
+    return [path for writer in writers for path in writer.paths]
+
+
+def block_rows_for_budget(n_cols, dtype, memory_budget_bytes, n_buffers=2):
+    """Rows per block so that n_buffers blocks of n_cols columns fit in the budget."""
+    return max(1, int(memory_budget_bytes // (n_buffers * n_cols * np.dtype(dtype).itemsize)))
+
+
+def save_matrix(matrix, ids, base_path, formats, id_field, row_labels=None, col_labels=None):
+    """Save an in-memory n x n matrix in each requested format; returns the written paths."""
+    writers = open_matrix_writers(base_path, formats, matrix.shape, matrix.dtype, ids, id_field,
+                                  row_labels=row_labels, col_labels=col_labels)
+    return stream_matrix_blocks([(0, matrix)], writers)
+
+
+def save_sparse_matrix(matrix, ids, base_path, formats, id_field, value_name="value"):
+    """Save a sparse n x n matrix as (row, col, value) triplets; returns the written paths.
+
+    "csv" and "mat" hold 1-based row and col indices, ready for MATLAB's
+    sparse(row, col, value, n, n); pairs that are not listed are beyond
+    the cutoff. "npz" is a SciPy CSR file (scipy.sparse.load_npz). Row and
+    column k refer to ids[k], listed in <base_path>_ids.csv.
+    """
+    coo = matrix.tocoo()
+    rows = (coo.row + 1).astype(np.float64)
+    cols = (coo.col + 1).astype(np.float64)
+    ids_path = f"{base_path}_ids.csv"
+    pd.DataFrame({id_field: ids}).to_csv(ids_path, index=False)
+    written = []
+    for fmt in formats:
+        path = f"{base_path}.{fmt}"
+        if fmt == "csv":
+            pd.DataFrame({"row": coo.row + 1, "col": coo.col + 1, value_name: coo.data}).to_csv(path, index=False)
+        elif fmt == "mat":
+            if rows.nbytes > MAT_FILE_LIMIT_BYTES:
+                raise ValueError(f"{coo.nnz} entries exceed the 2 GB variable limit of .mat files. Use 'npz' or 'csv'.")
+            savemat(path, {
+                "row": rows.reshape(-1, 1),
+                "col": cols.reshape(-1, 1),
+                value_name: coo.data.astype(np.float64).reshape(-1, 1),
+                "n": float(matrix.shape[0]),
+                id_field: np.asarray(ids).reshape(-1, 1),
+            }, do_compression=False)
+        elif fmt == "npz":
+            save_npz(path, matrix.tocsr(), compressed=False)
+        else:
+            raise ValueError(f"Unknown sparse matrix format '{fmt}'. Choose from {SPARSE_MATRIX_FORMATS}.")
+        written.append(path)
+    return written + [ids_path]
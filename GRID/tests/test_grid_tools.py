@@ -0,0 +1,122 @@
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "GRID-toolkit"))
+from grid_tools import (
+    hex_cells, hex_manifest, parent_ids, point_cell_ids, read_point_coordinates, roll_up_means, square_cells,
+    square_manifest,
+)
+
+CRS = "EPSG:32610"
+X0, Y0 = 500_000.0, 4_200_000.0
+N = 8  # base grid of N x N cells of 1 km
+
+
+def square_grid(factor):
+    n_cols = N // factor
+    cell_id, _, rings = square_cells(X0, Y0, 1000.0 * factor, n_cols, 0, n_cols)
+    return gpd.GeoDataFrame({"cell_id": cell_id}, geometry=shapely.polygons(rings), crs=CRS)
+
+
+def polygon_inputs(n=400, seed=0):
+    """Boxes from 0.1 to 3 km wide, so many span several base cells."""
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(X0, X0 + N * 1000, n)
+    y = rng.uniform(Y0 - N * 1000, Y0, n)
+    w, h = rng.uniform(100, 3000, (2, n))
+    return gpd.GeoDataFrame(
+        {"pop_sh": rng.exponential(1, n), "emp_sh": rng.exponential(1, n)},
+        geometry=shapely.box(x, y, x + w, y + h),
+        crs=CRS,
+    )
+
+
+@pytest.mark.parametrize("factor", [2, 4])
+def test_roll_up_equals_join_on_coarse_grid(factor):
+    inputs = polygon_inputs()
+    columns = ["pop_sh", "emp_sh"]
+    fine = square_grid(1)
+    pairs = gpd.sjoin(inputs, fine, how="inner", predicate="intersects")
+    parent = pd.Series(parent_ids(fine["cell_id"].to_numpy(), N, factor), index=fine["cell_id"].to_numpy())
+
+    rolled = roll_up_means(pairs, columns, parent).set_index("cell_id")
+    direct = gpd.sjoin(inputs, square_grid(factor), how="inner", predicate="intersects")
+    direct = direct.groupby("cell_id")[columns].mean()
+
+    assert rolled.index.equals(direct.index)
+    np.testing.assert_allclose(rolled[columns].to_numpy(), direct.to_numpy(), rtol=1e-12)
+
+
+def grid_and_manifest(shape):
+    if shape == "square":
+        cell_id, _, rings = square_cells(X0, Y0, 1000.0, N, 0, N)
+        manifest = square_manifest(CRS, X0, Y0, 1000.0, N, N)
+    else:
+        cell_id, _, rings = hex_cells(X0, Y0, 500.0, N, 0, N)
+        manifest = hex_manifest(CRS, X0, Y0, 500.0, N, N)
+    grid = gpd.GeoDataFrame({"cell_id": cell_id}, geometry=shapely.polygons(rings), crs=CRS)
+    return grid, manifest
+
+
+def sample_points(grid, n=5000, seed=0):
+    """Random points over and around the grid, plus every cell vertex and edge midpoint."""
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = grid.total_bounds
+    x = rng.uniform(xmin - 500, xmax + 500, n)
+    y = rng.uniform(ymin - 500, ymax + 500, n)
+    rings = shapely.get_coordinates(grid.boundary.values).reshape(len(grid), -1, 2)
+    edges = np.concatenate([rings[:, :-1], (rings[:, :-1] + rings[:, 1:]) / 2], axis=1).reshape(-1, 2)
+    return np.concatenate([x, edges[:, 0]]), np.concatenate([y, edges[:, 1]])
+
+
+def cells_per_point(points, grid, predicate):
+    """Set of grid cell_ids each point joins to (empty when none)."""
+    joined = gpd.sjoin(points, grid, how="left", predicate=predicate)
+    return joined.groupby(level=0)["cell_id"].agg(lambda c: set(c.dropna().astype(int))).to_numpy()
+
+
+@pytest.mark.parametrize("shape", ["square", "hex"])
+def test_point_cell_ids_match_within_join(shape):
+    grid, manifest = grid_and_manifest(shape)
+    x, y = sample_points(grid)
+    points = gpd.GeoDataFrame(geometry=shapely.points(x, y), crs=CRS)
+    ids = point_cell_ids(manifest, x, y)
+
+    # Hexagon rings of neighbouring cells agree only to ~1e-12 m, so an edge point can be "within" both;
+    # points on the grid's outer edge may fall on either side of it
+    within = cells_per_point(points, grid, "within")
+    touching = cells_per_point(points, grid, "intersects")
+    outer = shapely.dwithin(points.geometry.values, grid.union_all().boundary, 1e-6)
+    inside = np.array([bool(cells) for cells in within])
+    assert inside.sum() > 0 and (~inside).sum() > 0
+    for i in np.flatnonzero(inside):
+        assert ids[i] in within[i] | ({0} if outer[i] else set())
+
+    # Points on a cell edge go to one of the touching cells; points off the grid get 0
+    for i in np.flatnonzero(~inside):
+        assert ids[i] in touching[i] | ({0} if outer[i] or not touching[i] else set())
+
+
+def test_read_point_coordinates(tmp_path):
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(0, 1000, (2, 50))
+    path = str(tmp_path / "points.shp")
+    gpd.GeoDataFrame({"pop_sh": np.arange(50.0)}, geometry=shapely.points(x, y), crs=CRS).to_file(path)
+
+    attributes, px, py, crs = read_point_coordinates(path, columns=["pop_sh", "missing"])
+    assert list(attributes.columns) == ["pop_sh"]
+    np.testing.assert_array_equal(attributes["pop_sh"].to_numpy(), np.arange(50.0))
+    np.testing.assert_array_equal(px, x)
+    np.testing.assert_array_equal(py, y)
+    assert crs is not None
+
+    path = str(tmp_path / "boxes.shp")
+    gpd.GeoDataFrame(geometry=shapely.box(x, y, x + 1, y + 1), crs=CRS).to_file(path)
+    with pytest.raises(ValueError):
+        read_point_coordinates(path)
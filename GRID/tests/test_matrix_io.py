@@ -0,0 +1,121 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.io import loadmat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from matrix_io import (
+    CsvMatrixWriter, TiledMatrix, TiledMatrixWriter, block_rows_for_budget, open_matrix_writers, save_matrix,
+    stream_matrix_blocks,
+)
+
+
+def awkward_matrix(dtype, n_rows=7, n_cols=9, seed=0):
+    """Values over many magnitudes and signs, plus zeros, NaN, infinities and -0.0."""
+    rng = np.random.default_rng(seed)
+    matrix = rng.lognormal(0, 5, (n_rows, n_cols)) * rng.choice([-1, 1], (n_rows, n_cols))
+    matrix[np.diag_indices(min(n_rows, n_cols))] = 0.0
+    matrix[1, 2], matrix[2, 3], matrix[3, 4], matrix[4, 5] = np.nan, np.inf, -np.inf, -0.0
+    matrix[5, 6], matrix[6, 7] = 1e-5, 123456789.0
+    return matrix.astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_csv_writer_matches_pandas(tmp_path, dtype):
+    matrix = awkward_matrix(dtype)
+    rows, cols = [f"r{i}" for i in range(len(matrix))], [f"c{j}" for j in range(matrix.shape[1])]
+    path = str(tmp_path / "matrix.csv")
+    # Uneven blocks, each written in sub-blocks of a few rows
+    writer = CsvMatrixWriter(path, rows, cols, index_label="id", block_cells=20)
+    writer.write_rows(0, matrix[:3])
+    writer.write_rows(3, matrix[3:])
+    writer.close()
+
+    with open(path, newline="") as f:
+        assert f.read() == pd.DataFrame(matrix, index=rows, columns=cols).to_csv(index_label="id", lineterminator="\n")
+
+
+def uneven_blocks(matrix, stops=(4, 5)):
+    """(start, block) row blocks of different heights, the last one running to the end."""
+    starts = (0,) + tuple(stops)
+    stops = tuple(stops) + (len(matrix),)
+    return [(start, matrix[start:stop]) for start, stop in zip(starts, stops)]
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_streamed_formats_round_trip(tmp_path, dtype):
+    matrix = awkward_matrix(dtype, 11, 11)
+    ids = np.arange(101, 112)
+    base = str(tmp_path / "matrix")
+    writers = open_matrix_writers(base, ["csv", "npy", "tiles"], matrix.shape, dtype, ids, "cell_id")
+    paths = stream_matrix_blocks(uneven_blocks(matrix), writers)
+    assert paths == [f"{base}.csv", f"{base}.npy", f"{base}_ids.csv", f"{base}.tiles"]
+
+    csv = pd.read_csv(f"{base}.csv", index_col=0, float_precision="round_trip")
+    assert csv.index.name == "cell_id" and list(csv.index) == list(ids) and list(csv.columns) == list(map(str, ids))
+    np.testing.assert_array_equal(csv.to_numpy(dtype=dtype), matrix)
+    npy = np.load(f"{base}.npy")
+    assert npy.dtype == np.dtype(dtype).newbyteorder("<")
+    np.testing.assert_array_equal(npy, matrix)
+    np.testing.assert_array_equal(pd.read_csv(f"{base}_ids.csv")["cell_id"], ids)
+    tiles = TiledMatrix(f"{base}.tiles")
+    np.testing.assert_array_equal(tiles.block(), matrix)
+    np.testing.assert_array_equal(tiles.ids, ids)
+
+
+def test_mat_round_trip_and_single_block(tmp_path):
+    matrix = awkward_matrix(np.float64, 11, 11)
+    ids = np.arange(101, 112)
+    base = str(tmp_path / "matrix")
+    assert save_matrix(matrix, ids, base, ["mat"], "cell_id") == [f"{base}.mat"]
+    mat = loadmat(f"{base}.mat")
+    np.testing.assert_array_equal(mat["matrix"], matrix)
+    np.testing.assert_array_equal(mat["cell_id"].ravel(), ids)
+
+    # .mat files are written in one piece, so streamed row blocks are rejected
+    writers = open_matrix_writers(base, ["mat"], matrix.shape, matrix.dtype, ids, "cell_id")
+    with pytest.raises(ValueError):
+        stream_matrix_blocks(uneven_blocks(matrix), writers)
+
+
+def test_failed_stream_aborts_writers(tmp_path):
+    matrix = awkward_matrix(np.float64, 11, 11)
+    ids = np.arange(101, 112)
+    base = str(tmp_path / "matrix")
+    save_matrix(matrix, ids, base, ["tiles"], "cell_id")
+
+    # The 'mat' writer rejects the first streamed block; the others must not be left open or look complete
+    writers = open_matrix_writers(base, ["csv", "tiles", "mat"], matrix.shape, matrix.dtype, ids, "cell_id")
+    with pytest.raises(ValueError):
+        stream_matrix_blocks(uneven_blocks(matrix), writers)
+    assert writers[0]._file.closed
+    assert not os.path.exists(os.path.join(f"{base}.tiles", "matrix.json"))
+    with pytest.raises(FileNotFoundError):
+        TiledMatrix(f"{base}.tiles")
+
+
+def test_tiled_matrix_access(tmp_path):
+    # 4-column tiles and uneven row blocks, so most requests cut across several tiles
+    matrix = awkward_matrix(np.float64, 11, 10)
+    path = str(tmp_path / "matrix.tiles")
+    writer = TiledMatrixWriter(path, matrix.shape, matrix.dtype, np.arange(11), "cell_id", tile_cols=4)
+    stream_matrix_blocks(uneven_blocks(matrix, stops=(3, 4, 9)), [writer])
+
+    tiles = TiledMatrix(path)
+    assert tiles.shape == matrix.shape and tiles.dtype == matrix.dtype
+    np.testing.assert_array_equal(tiles.rows(2, 10), matrix[2:10])
+    np.testing.assert_array_equal(tiles.cols(3, 9), matrix[:, 3:9])
+    np.testing.assert_array_equal(tiles.block(slice(1, 8), slice(5, None)), matrix[1:8, 5:])
+    np.testing.assert_array_equal(tiles[4:5], matrix[4:5])
+    np.testing.assert_array_equal(tiles[-3:], matrix[-3:])
+    assert tiles.rows(6, 6).shape == (0, 10)
+
+
+def test_block_rows_for_budget():
+    # Two buffers of 37 rows of 1,000 float64 values
+    assert block_rows_for_budget(1000, np.float64, 2 * 37 * 1000 * 8) == 37
+    assert block_rows_for_budget(1000, np.float32, 2 * 37 * 1000 * 8) == 74
+    assert block_rows_for_budget(1000, np.float64, 1) == 1
@@ -0,0 +1,275 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TTMATRIX-toolkit"))
+from ttmatrix_engine import (
+    AccessibilityReducer, RoutingGraph, ScenarioDelta, compute_sparse_travel_times, compute_travel_time_matrix, iter_travel_time_blocks, nearest_links,
+    network_segments, travel_time_matrix_skim,
+)
+
+EXTENT = 10_000.0  # network, stations and points lie in a 10 x 10 km square
+WALKING_SPEED_KMH = 5
+
+
+def network_lines(seed=0):
+    """Lattice of lines every 2 km with a vertex every 500 m.
+
+    Vertices between junctions are shifted sideways, so segment lengths
+    differ and the lines form degree-2 transit chains between junctions.
+    """
+    rng = np.random.default_rng(seed)
+    along = np.arange(0.0, EXTENT + 1, 500.0)
+    lines = []
+    for offset in np.arange(0.0, EXTENT + 1, 2000.0):
+        for horizontal in (True, False):
+            side = np.where(along % 2000 == 0, 0.0, rng.uniform(-150, 150, len(along)))
+            xy = np.column_stack([along, offset + side] if horizontal else [offset + side, along])
+            lines.append(shapely.linestrings(xy))
+    return np.array(lines, dtype=object)
+
+
+def build_graph(n_points=60, n_stations=8, seed=0, network_speed_kmh=60, contract=False):
+    """Augmented graph built as in TTMATRIX-HSR.py: network, linked stations, walking points.
+
+    One line gets its own speed. With contract, transit chains are collapsed
+    after the stations are linked, as the script does. Returns (graph,
+    point_nodes, station_nodes).
+    """
+    rng = np.random.default_rng(seed)
+    lines = network_lines(seed)
+    speeds = np.full(len(lines), np.nan)
+    speeds[3] = 120.0
+    node_xy, seg_u, seg_v, length_m, speed_kmh = network_segments(lines, speeds=speeds)
+    graph = RoutingGraph.from_segments(node_xy, seg_u, seg_v, length_m, speed_kmh, network_speed_kmh)
+
+    station_nodes = [f"station_{k}" for k in range(n_stations)]
+    station_xy = rng.uniform(0, EXTENT, (n_stations, 2))
+    station_ids = graph.add_nodes(station_nodes, station_xy)
+    _, nearest = cKDTree(node_xy).query(station_xy, k=1)
+    graph.add_edges(station_ids, nearest, np.full(n_stations, 0.0001), np.nan, kind="link")
+    if contract:
+        graph = graph.contract_transit_chains(keep=station_nodes)
+        station_ids = np.array([graph.node_ids[name] for name in station_nodes], dtype=np.int64)
+
+    point_nodes = [f"point_{k}" for k in range(n_points)]
+    point_xy = rng.uniform(0, EXTENT, (n_points, 2))
+    point_ids = graph.add_nodes(point_nodes, point_xy)
+    for targets, ids, k, exclude_self in ((station_xy, station_ids, 2, False), (point_xy, point_ids, 3, True)):
+        src, dst, dist_m = nearest_links(point_xy, targets, k, exclude_self=exclude_self)
+        graph.add_edges(point_ids[src], ids[dst], np.zeros(len(src)), dist_m, kind="walk")
+    graph.set_walking_speed(WALKING_SPEED_KMH)
+    return graph, point_nodes, station_nodes
+
+
+def test_scipy_matrix_equals_networkx():
+    graph, point_nodes, _ = build_graph()
+    scipy_times = compute_travel_time_matrix(graph, point_nodes, backend="scipy")
+    networkx_times = compute_travel_time_matrix(graph, point_nodes, backend="networkx")
+
+    assert np.isfinite(scipy_times).all()
+    np.testing.assert_array_equal(scipy_times, networkx_times)
+
+
+def test_contracted_matrix_equals_full_graph():
+    graph, point_nodes, _ = build_graph()
+    contracted, _, _ = build_graph(contract=True)
+    assert len(contracted.nodes) < len(graph.nodes)
+    assert len(contracted.edge_u) < len(graph.edge_u)
+
+    # Also after a scenario changes the network speed, which rescales the summed chain weights
+    for network_speed_kmh in (60, 90):
+        graph.set_network_speed(network_speed_kmh)
+        contracted.set_network_speed(network_speed_kmh)
+        full_times = compute_travel_time_matrix(graph, point_nodes)
+        contracted_times = compute_travel_time_matrix(contracted, point_nodes)
+        # Summed chain weights differ from the per-segment sums only in rounding
+        np.testing.assert_allclose(contracted_times, full_times, rtol=1e-12)
+
+
+@pytest.mark.parametrize("backend", ["scipy", "networkx"])
+def test_parallel_matrix_equals_serial(backend):
+    # 7-row chunks do not divide the 60 origins, so the last chunk is short
+    graph, point_nodes, _ = build_graph()
+    serial = compute_travel_time_matrix(graph, point_nodes, backend=backend)
+    parallel = compute_travel_time_matrix(graph, point_nodes, backend=backend, n_workers=2, chunk_size=7)
+    assert np.array_equal(serial, parallel)
+
+
+def test_parallel_blocks_equal_serial():
+    # Blocks of 16 rows alternate between two shared buffers; each block is copied before the next is filled
+    graph, point_nodes, _ = build_graph()
+    serial = compute_travel_time_matrix(graph, point_nodes)
+    blocks = iter_travel_time_blocks(graph, point_nodes, 16, n_workers=2, chunk_size=5)
+    parallel = np.vstack([block.copy() for _, block in blocks])
+    assert np.array_equal(serial, parallel)
+
+
+def test_skim_matrix_equals_scipy():
+    graph, point_nodes, station_nodes = build_graph()
+    scipy_times = compute_travel_time_matrix(graph, point_nodes)
+    skim_times = travel_time_matrix_skim(graph, point_nodes, station_nodes, block_cells=1000)
+    np.testing.assert_allclose(skim_times, scipy_times, rtol=1e-12)
+
+
+def test_tiled_skim_equals_scipy_without_walking_matrix():
+    graph, point_nodes, station_nodes = build_graph()
+    scipy_times = compute_travel_time_matrix(graph, point_nodes)
+    blocks = iter_travel_time_blocks(graph, point_nodes, 16, backend="skim", station_nodes=station_nodes)
+    skim_times = np.vstack([block.copy() for _, block in blocks])
+    np.testing.assert_allclose(skim_times, scipy_times, rtol=1e-12)
+    # Walking rows were routed per block: only the n x k access times are cached, not the n x n walking matrix
+    assert all(key[0] == "access" for key in graph._walking_legs)
+
+
+def test_cutoff_skim_equals_scipy():
+    graph, point_nodes, station_nodes = build_graph()
+    max_time = np.median(compute_travel_time_matrix(graph, point_nodes))
+    scipy_times = compute_sparse_travel_times(graph, point_nodes, max_time)
+    skim_times = compute_sparse_travel_times(graph, point_nodes, max_time, backend="skim", station_nodes=station_nodes)
+    assert all(key[0] == "access" for key in graph._walking_legs)
+
+    assert 0 < scipy_times.nnz < len(point_nodes) ** 2
+    np.testing.assert_array_equal(skim_times.indptr, scipy_times.indptr)
+    np.testing.assert_array_equal(skim_times.indices, scipy_times.indices)
+    np.testing.assert_allclose(skim_times.data, scipy_times.data, rtol=1e-12)
+
+
+def direct_accessibility(times, pop, emp, thresholds, decay):
+    """Accessibility measures computed from the full matrix at once (NaN = unreachable)."""
+    reachable = ~np.isnan(times)
+    filled = np.nan_to_num(times)
+    with np.errstate(invalid="ignore"):
+        out = {"mean_time_min": filled.sum(axis=1) / reachable.sum(axis=1)}
+        for field, w in (("pop", pop), ("emp", emp)):
+            out[f"{field}_wtime"] = (filled @ w) / (reachable @ w)
+    for threshold in thresholds:
+        out[f"emp_{threshold:g}min"] = (times <= threshold) @ emp
+    out["mkt_access"] = np.where(reachable, np.exp(-decay * filled), 0.0) @ emp
+    return pd.DataFrame(out)
+
+
+def accessibility_reducer(n, pop, emp, thresholds, decay):
+    return AccessibilityReducer(n, weights={"pop": pop, "emp": emp}, jobs_field="emp", thresholds_min=thresholds,
+                                decay=decay)
+
+
+def test_block_folded_accessibility_equals_full_matrix():
+    graph, point_nodes, _ = build_graph()
+    times = compute_travel_time_matrix(graph, point_nodes)
+    times[4, :] = np.nan  # an origin that reaches nothing
+    times[[0, 7, 30], [9, 2, 41]] = np.nan
+    rng = np.random.default_rng(1)
+    pop, emp = rng.uniform(0, 100, (2, len(times)))
+    thresholds, decay = (15, 30), 0.05
+
+    reducer = accessibility_reducer(len(times), pop, emp, thresholds, decay)
+    # Uneven disjoint blocks, each folded in sub-blocks of 2 rows (block_cells = 2n)
+    for start, stop in ((0, 13), (13, 14), (14, len(times))):
+        reducer.set_rows(start, times[start:stop], block_cells=2 * len(times))
+    expected = direct_accessibility(times, pop, emp, thresholds, decay)
+    pd.testing.assert_frame_equal(reducer.results(), expected, check_exact=False, rtol=1e-12)
+    assert reducer.results()["mean_time_min"].isna().sum() == 1
+
+
+def test_sparse_accessibility_equals_full_matrix():
+    graph, point_nodes, _ = build_graph()
+    sparse = compute_sparse_travel_times(graph, point_nodes, 30)
+    coo = sparse.tocoo()
+    times = np.full(sparse.shape, np.nan)
+    times[coo.row, coo.col] = coo.data
+    rng = np.random.default_rng(1)
+    pop, emp = rng.uniform(0, 100, (2, len(times)))
+    thresholds, decay = (15, 30), 0.05
+
+    reducer = accessibility_reducer(len(times), pop, emp, thresholds, decay)
+    reducer.set_sparse(sparse)
+    expected = direct_accessibility(times, pop, emp, thresholds, decay)
+    pd.testing.assert_frame_equal(reducer.results(), expected, check_exact=False, rtol=1e-12)
+
+
+def scenario_matrices(max_time=None):
+    """Baseline and scenario times: a faster network, but slower walking, so some pairs also get slower."""
+    graph, point_nodes, _ = build_graph()
+    times = []
+    for network_speed_kmh, walking_speed_kmh in ((60, WALKING_SPEED_KMH), (120, 4)):
+        graph.set_network_speed(network_speed_kmh)
+        graph.set_walking_speed(walking_speed_kmh)
+        if max_time is None:
+            times.append(compute_travel_time_matrix(graph, point_nodes))
+        else:
+            times.append(compute_sparse_travel_times(graph, point_nodes, max_time))
+    return times
+
+
+def expected_delta(old, new):
+    """Changed pairs of two dense matrices (NaN = unreachable) and their times."""
+    changed = (old != new) & ~(np.isnan(old) & np.isnan(new))
+    rows, cols = np.nonzero(changed)
+    return rows, cols, old[rows, cols], new[rows, cols], changed.any(axis=1)
+
+
+def assert_delta_equal(delta, old, new):
+    rows, cols, old_times, new_times, origins = expected_delta(old, new)
+    got_rows, got_cols, got_old, got_new = delta.pairs()
+    np.testing.assert_array_equal(got_rows, rows)
+    np.testing.assert_array_equal(got_cols, cols)
+    np.testing.assert_array_equal(got_old, old_times)
+    np.testing.assert_array_equal(got_new, new_times)
+    np.testing.assert_array_equal(delta.changed_origins, origins)
+
+
+def test_delta_holds_exactly_the_changed_pairs():
+    old, new = scenario_matrices()
+    # Pairs that become reachable, become unreachable, or stay unreachable
+    old[0, 5] = new[3, 7] = old[2, 9] = new[2, 9] = np.nan
+    assert (new > old).any() and (new < old).any()
+
+    delta = ScenarioDelta(len(old), tolerance=0.0)
+    for start, stop in ((0, 13), (13, 14), (14, len(old))):
+        delta.add(start, old[start:stop], new[start:stop], block_cells=150)
+    assert_delta_equal(delta, old, new)
+
+
+def test_sparse_delta_holds_exactly_the_changed_pairs():
+    old, new = scenario_matrices(max_time=30)
+
+    def dense(matrix):
+        # Stored pairs, explicit zeros such as the diagonal included, are within reach; the rest is NaN
+        coo = matrix.tocoo()
+        out = np.full(matrix.shape, np.nan)
+        out[coo.row, coo.col] = coo.data
+        return out
+
+    dense_old, dense_new = dense(old), dense(new)
+    appear = np.isnan(dense_old) & ~np.isnan(dense_new)
+    disappear = ~np.isnan(dense_old) & np.isnan(dense_new)
+    assert appear.any() and disappear.any()
+
+    delta = ScenarioDelta(old.shape[0], tolerance=0.0)
+    delta.add_sparse(old, new)
+    assert_delta_equal(delta, dense_old, dense_new)
+
+
+def test_delta_files(tmp_path):
+    old, new = scenario_matrices()
+    delta = ScenarioDelta(len(old))
+    delta.add(0, old, new)
+    ids = np.arange(1, len(old) + 1) * 10
+    base = str(tmp_path / "delta")
+    assert delta.save(base, ids, "cell_id", ["csv"]) == [f"{base}.csv", f"{base}_origins.csv"]
+
+    rows, cols, old_times, new_times = delta.pairs()
+    pairs = pd.read_csv(f"{base}.csv", float_precision="round_trip")
+    np.testing.assert_array_equal(pairs["row"], rows + 1)
+    np.testing.assert_array_equal(pairs["col"], cols + 1)
+    np.testing.assert_array_equal(pairs["old_time_min"], old_times)
+    np.testing.assert_array_equal(pairs["new_time_min"], new_times)
+    origins = pd.read_csv(f"{base}_origins.csv")
+    np.testing.assert_array_equal(origins["cell_id"], ids)
+    np.testing.assert_array_equal(origins["changed"], delta.changed_origins)
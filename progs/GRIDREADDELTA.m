@@ -0,0 +1,58 @@
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+%%% Master MATLAB programme file for the MRRH2018 tolkit by             %%%
+%%% Gabriel Ahlfeldt M. Ahlfeldt and Tobias Seidel                      %%%
+%%% The toolkit covers a class of quantitative spatial models           %%%
+%%% introduced in Monte, Redding, Rossi-Hansberg (2018): Commuting,     %%%
+%%% Migration, and Local Employment Elasticities.                       %%%
+%%% The toolkit uses data and code compiled for                         %%%
+%%% Seidel and Wckerath (2020): Rush hours and urbanization             %%%
+%%% Codes and data have been re-organized to make the toolkit more      %%%
+%%% accessible. Seval programmes have been added to allow for more      %%%
+%%% general applications. Discriptive analyses and counterfactuals      %%%
+%%% serve didactic purposes and are unrelated to both research papers   %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+% First version: Gabriel M Ahlfeldt, 11/2025                            %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+%%% This function is not part of the orginal directory                  %%%
+%%% This function reads the sparse list of OD pairs whose travel time   %%%
+%%% changed between two TTMATRIX scenarios (<basename>.mat or .csv      %%%
+%%% with <basename>_origins.csv), written in batch mode                 %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+% This below program uses the following inputs
+    % basename is the path of the delta file without file extension,
+        % e.g. 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-HSR-delta'
+% The below program produces the following outputs
+        % row, col are the (1-based) origin and destination indices of
+            % the changed pairs, in the cell_id order of the matrices
+        % TTold, TTnew are the baseline and scenario travel times of
+            % these pairs (NaN = unreachable)
+        % changedOrigins is a J x 1 logical, true for origins with at
+            % least one changed pair
+function [row, col, TTold, TTnew, changedOrigins] = GRIDREADDELTA(basename)
+
+    if exist([basename '.mat'], 'file') == 2
+        S = load([basename '.mat'], 'row', 'col', 'old_time_min', 'new_time_min', 'changed_origins');
+        row = S.row;
+        col = S.col;
+        TTold = S.old_time_min;
+        TTnew = S.new_time_min;
+        changedOrigins = S.changed_origins == 1;
+    elseif exist([basename '.csv'], 'file') == 2
+        % readmatrix keeps empty fields (unreachable pairs) as NaN
+        D = readmatrix([basename '.csv']);
+        row = D(:, 1);
+        col = D(:, 2);
+        TTold = D(:, 3);
+        TTnew = D(:, 4);
+        O = readmatrix([basename '_origins.csv']);
+        changedOrigins = O(:, 2) == 1;
+    else
+        error('No .mat or .csv delta file found for %s', basename);
+    end
+end
+
+
+% Code ends %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -0,0 +1,126 @@
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+%%% Master MATLAB programme file for the MRRH2018 tolkit by             %%%
+%%% Gabriel Ahlfeldt M. Ahlfeldt and Tobias Seidel                      %%%
+%%% The toolkit covers a class of quantitative spatial models           %%%
+%%% introduced in Monte, Redding, Rossi-Hansberg (2018): Commuting,     %%%
+%%% Migration, and Local Employment Elasticities.                       %%%
+%%% The toolkit uses data and code compiled for                         %%%
+%%% Seidel and Wckerath (2020): Rush hours and urbanization             %%%
+%%% Codes and data have been re-organized to make the toolkit more      %%%
+%%% accessible. Seval programmes have been added to allow for more      %%%
+%%% general applications. Discriptive analyses and counterfactuals      %%%
+%%% serve didactic purposes and are unrelated to both research papers   %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+% First version: Gabriel M Ahlfeldt, 11/2025                            %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+%%% This function is not part of the orginal directory                  %%%
+%%% This function reads a bilateral matrix written by the GRID- or      %%%
+%%% TTMATRIX-toolkit. It uses the fastest available format:             %%%
+%%% .mat, then .npy (raw little-endian binary), then a .tiles folder    %%%
+%%% (tiled mode, .npy tiles + matrix.json), then .csv. Sparse output  %%%
+%%% (travel time cutoff, <basename>_sparse.mat/.csv triplets) is used   %%%
+%%% last; pairs beyond the cutoff are returned as Inf                   %%%
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+% This below program uses the following inputs
+    % basename is the path of the matrix file without file extension,
+        % e.g. 'GRID/GRID-toolkit/output/distance_matrix'
+% The below program produces the following outputs
+        % M is the n x n matrix (double); rows and columns follow the
+            % cell_id order of the corresponding CSV file
+        % source is the file or .tiles folder that was read
+function [M, source] = GRIDREADMATRIX(basename)
+
+    % Prefer the binary formats; remove stale .mat/.npy files if you switch
+    % the Python scripts back to CSV-only output
+    exts = {'.mat', '.npy', '.tiles', '.csv'};
+    ext = '';
+    for k = 1:numel(exts)
+        if exist([basename exts{k}], 'file') == 2 || exist(fullfile([basename exts{k}], 'matrix.json'), 'file') == 2
+            ext = exts{k};
+            break
+        end
+    end
+
+    source = [basename ext];
+    switch ext
+        case '.mat'
+            S = load([basename '.mat'], 'matrix');
+            M = double(S.matrix);
+        case '.npy'
+            M = readNPY([basename '.npy']);
+        case '.tiles'
+            M = readTiles([basename '.tiles']);
+        case '.csv'
+            M = csvread([basename '.csv'], 1, 1);
+        otherwise
+            if exist([basename '_sparse.mat'], 'file') == 2
+                source = [basename '_sparse.mat'];
+                S = load([basename '_sparse.mat'], 'row', 'col', 'time_min', 'n');
+                M = Inf(S.n);
+                M(sub2ind([S.n S.n], S.row, S.col)) = S.time_min;
+            elseif exist([basename '_sparse.csv'], 'file') == 2
+                source = [basename '_sparse.csv'];
+                T = csvread([basename '_sparse.csv'], 1, 0);
+                n = size(csvread([basename '_sparse_ids.csv'], 1, 0), 1);
+                M = Inf(n);
+                M(sub2ind([n n], T(:, 1), T(:, 2))) = T(:, 3);
+            else
+                error('No .mat, .npy, .tiles, .csv or _sparse file found for %s', basename);
+            end
+    end
+end
+
+function M = readTiles(folder)
+    % Assemble a matrix from the row-block x column-block .npy tiles
+    manifest = jsondecode(fileread(fullfile(folder, 'matrix.json')));
+    n = manifest.shape(:)';
+    rowStarts = [manifest.row_starts(:)' n(1)];
+    M = zeros(n);
+    for r = 1:numel(rowStarts) - 1
+        for c0 = 0:manifest.tile_cols:n(2) - 1
+            tile = readNPY(fullfile(folder, sprintf('tile_%d_%d.npy', rowStarts(r), c0)));
+            M(rowStarts(r) + 1:rowStarts(r + 1), c0 + 1:c0 + size(tile, 2)) = tile;
+        end
+    end
+end
+
+function M = readNPY(filename)
+    % Minimal reader for 2-D little-endian float32/float64 .npy files
+    fid = fopen(filename, 'r', 'ieee-le');
+    cleanup = onCleanup(@() fclose(fid));
+    magic = fread(fid, 6, 'uint8=>char')';
+    if ~strcmp(magic(2:end), 'NUMPY')
+        error('%s is not a .npy file', filename);
+    end
+    version = fread(fid, 2, 'uint8');
+    if version(1) == 1
+        headerLength = fread(fid, 1, 'uint16');
+    else
+        headerLength = fread(fid, 1, 'uint32');
+    end
+    header = fread(fid, headerLength, 'uint8=>char')';
+
+    if contains(header, '''<f8''')
+        precision = 'double';
+    elseif contains(header, '''<f4''')
+        precision = 'single';
+    else
+        error('Unsupported .npy data type in %s', filename);
+    end
+    shape = str2double(regexp(header, '''shape'': \((\d+), (\d+)\)', 'tokens', 'once'));
+    fortranOrder = contains(header, '''fortran_order'': True');
+
+    % NumPy stores rows contiguously (C order); MATLAB fills columns first
+    if fortranOrder
+        M = fread(fid, shape, ['*' precision]);
+    else
+        M = fread(fid, fliplr(shape), ['*' precision])';
+    end
+    M = double(M);
+end
+
+
+% Code ends %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -39,15 +39,39 @@ dChange = ones(J,J);
 %dist_mat = csvread(dataDistance, 1, 1);
 
 % Prepare change in commuting cost matrix
-dataDistance = 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-noHSR.csv'; % read no HSR
-TTnoHSR_mat = csvread(dataDistance, 1, 1);
-TTnoHSR_mat(1:size(TTnoHSR_mat,1)+1:end) = 1; % replace values on diagonal to 1
-dataDistance = 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-HSR.csv'; % Read HSR
-TTHSR_mat = csvread(dataDistance, 1, 1);
-TTHSR_mat(1:size(TTnoHSR_mat,1)+1:end) = 1; % replace values on diagonal to 1
-
-% Compute relative change in commuting cost
-kapChange = TTHSR_mat./TTnoHSR_mat;
+useDelta = true; % true: only the OD pairs changed by HSR (TTMATRIX batch-mode delta file); false: both full matrices
+dataDelta = 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-HSR-delta'; % OD pairs changed by HSR (.mat or .csv)
+dataNoHSR = 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-noHSR'; % no HSR (.mat, .npy, .tiles or .csv)
+dataHSR = 'GRID/TTMATRIX-toolkit/output/TTMATRIX-HSR-HSR'; % HSR (.mat, .npy, .tiles or .csv)
+if useDelta
+    deltaFile = [dataDelta '.mat'];
+    if exist(deltaFile, 'file') ~= 2
+        deltaFile = [dataDelta '.csv'];
+    end
+    if exist(deltaFile, 'file') ~= 2
+        error('No delta file %s(.mat|.csv). Run TTMATRIX in batch mode with delta_baseline_scenario set, or set useDelta = false.', dataDelta);
+    end
+    % The delta is written after both scenario matrices; a matrix written later means the delta is stale
+    deltaInfo = dir(deltaFile);
+    scenarioInfo = [dir([dataNoHSR '.*']); dir([dataNoHSR '_sparse.*']); dir([dataHSR '.*']); dir([dataHSR '_sparse.*'])];
+    scenarioInfo = scenarioInfo(endsWith({scenarioInfo.name}, {'.mat', '.npy', '.tiles', '.csv'}));
+    if any([scenarioInfo.datenum] > deltaInfo.datenum)
+        error('%s is older than the scenario matrices. Re-run TTMATRIX with delta_baseline_scenario set, or set useDelta = false.', deltaFile);
+    end
+    fprintf('Travel time changes read from %s\n', deltaFile);
+    % Only update the pairs whose travel time changed; all others stay at 1
+    [deltaRow, deltaCol, TTold, TTnew] = GRIDREADDELTA(dataDelta);
+    kapChange(sub2ind([J J], deltaRow, deltaCol)) = TTnew./TTold;
+else
+    [TTnoHSR_mat, noHSRFile] = GRIDREADMATRIX(dataNoHSR);
+    TTnoHSR_mat(1:size(TTnoHSR_mat,1)+1:end) = 1; % replace values on diagonal to 1
+    [TTHSR_mat, HSRFile] = GRIDREADMATRIX(dataHSR);
+    TTHSR_mat(1:size(TTnoHSR_mat,1)+1:end) = 1; % replace values on diagonal to 1
+    fprintf('Travel times read from %s and %s\n', noHSRFile, HSRFile);
+
+    % Compute relative change in commuting cost
+    kapChange = TTHSR_mat./TTnoHSR_mat;
+end
 kapChange_avg = mean(kapChange, 2);
 
 % Extract only entries that are not equal to 1
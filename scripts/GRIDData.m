@@ -30,9 +30,9 @@
 clear;
 load('data/output/parameters');
 % Read in your matrices; 
-dataDistance = 'GRID/GRID-toolkit/output/distance_matrix.csv';
+dataDistance = 'GRID/GRID-toolkit/output/distance_matrix';                % .mat, .npy or .csv (see DISTANCE_MATRIX_FORMATS in GRID-data.py)
 % dataComm = 'commuting_wide.csv';           
-dist_mat = csvread(dataDistance, 1, 1);
+dist_mat = GRIDREADMATRIX(dataDistance);
 dist_mat = dist_mat./1000; %  
 dni = (dist_mat./min(dist_mat(:))).^psi;                                    % Distance elasticity taken from Head/ Mayer, cost elasticity assuming sigma 4 from Broda and Weinstein (2004)
                                                                             % Replace with your distance measure!